@@ -1,85 +1,27 @@
 
-AddressDictionary = {
-    # DBA 1
-    "DBA1_DPM1": 0x00,
-    "DBA1_DPM2": 0x01,
-    "DBA1_DPM3": 0x02,
-    "DBA1_DPM4": 0x03,
-    "DBA1_DPM5": 0x04,
-    "DBA1_DPM6": 0x05,
-    "DBA1_DPM7": 0x06,
-    "DBA1_DPM8": 0x07,
+# The address tables are generated from the default topology, see topology.json.
+# They are built on first use, importing this module doesn't read the file.
+import os
 
-    "DBA1_DTL1": 0x80,
-    "DBA1_DTL2": 0x81,
-    "DBA1_DTL3": 0x82,
-    "DBA1_DTL4": 0x83,
-    "DBA1_DTL5": 0x84,
-    "DBA1_DTL6": 0x85,
-    "DBA1_DTL7": 0x86,
-    "DBA1_DTL8": 0x87,
+from topology import Topology, TOPOLOGY_FILE
 
-    # DBA 2
-    "DBA2_DPM1": 0x10,
-    "DBA2_DPM2": 0x11,
-    "DBA2_DPM3": 0x12,
-    "DBA2_DPM4": 0x13,
-    "DBA2_DPM5": 0x14,
-    "DBA2_DPM6": 0x15,
-    "DBA2_DPM7": 0x16,
-    "DBA2_DPM8": 0x17,
+_tables = None
 
-    "DBA2_DTL1": 0x90,
-    "DBA2_DTL2": 0x91,
-    "DBA2_DTL3": 0x92,
-    "DBA2_DTL4": 0x93,
-    "DBA2_DTL5": 0x94,
-    "DBA2_DTL6": 0x95,
-    "DBA2_DTL7": 0x96,
-    "DBA2_DTL8": 0x97,
 
-    # DBA 3
-    "DBA3_DPM1": 0x20,
-    "DBA3_DPM2": 0x21,
-    "DBA3_DPM3": 0x22,
-    "DBA3_DPM4": 0x23,
-    "DBA3_DPM5": 0x24,
-    "DBA3_DPM6": 0x25,
-    "DBA3_DPM7": 0x26,
-    "DBA3_DPM8": 0x27,
+def _load():
+    global _tables  # pylint: disable=global-statement
+    if _tables is None:
+        topology = Topology.load(os.path.join(os.path.dirname(os.path.abspath(__file__)), TOPOLOGY_FILE))
+        _tables = {
+            # {"DBA1_DPM1": 0x00, ... "DBA4_DTL8": 0xB7}
+            'AddressDictionary': dict(topology.by_name),
+            # Supply's and their LUNs for the GetEnviornment
+            'SupplyLUN': dict(topology.supplies),
+        }
+    return _tables
 
-    "DBA3_DTL1": 0xA0,
-    "DBA3_DTL2": 0xA1,
-    "DBA3_DTL3": 0xA2,
-    "DBA3_DTL4": 0xA3,
-    "DBA3_DTL5": 0xA4,
-    "DBA3_DTL6": 0xA5,
-    "DBA3_DTL7": 0xA6,
-    "DBA3_DTL8": 0xA7,
 
-    # DBA 4
-    "DBA4_DPM1": 0x30,
-    "DBA4_DPM2": 0x31,
-    "DBA4_DPM3": 0x32,
-    "DBA4_DPM4": 0x33,
-    "DBA4_DPM5": 0x34,
-    "DBA4_DPM6": 0x35,
-    "DBA4_DPM7": 0x36,
-    "DBA4_DPM8": 0x37,
-
-    "DBA4_DTL1": 0xB0,
-    "DBA4_DTL2": 0xB1,
-    "DBA4_DTL3": 0xB2,
-    "DBA4_DTL4": 0xB3,
-    "DBA4_DTL5": 0xB4,
-    "DBA4_DTL6": 0xB5,
-    "DBA4_DTL7": 0xB6,
-    "DBA4_DTL8": 0xB7
-}
-
-SupplyLUN = {
-    # Supply's and their LUNs for the GetEnviornment
-    "Supply0": 0x01,
-    "Supply1": 0x02,
-    "Supply2": 0x03
-}
+def __getattr__(name):
+    if name in ('AddressDictionary', 'SupplyLUN'):
+        return _load()[name]
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
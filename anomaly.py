@@ -0,0 +1,155 @@
+##
+# Module with the fleet anomaly detection used by the CUBEMELTER Tool
+#
+# Every sweep snapshot is turned into arrays laid out DBA x sled, so each check runs over the
+# whole fleet at once. A sled is flagged when its DPM current spikes, its DTL temperature is
+# high or climbs faster than its neighbours, or its DPM voltage sags, compared to the other
+# sleds of its DBA and to the whole fleet. The summed DPM power is also checked against the
+# DC power the supplies report.
+#
+# The scores are robust z-scores, (x - median) / (1.4826 * MAD), since a single hot sled
+# would inflate a plain standard deviation over only 8 sleds enough to hide itself.
+
+import warnings
+from collections import namedtuple
+
+import numpy as np
+
+from topology import ROLE_DPM, ROLE_DTL
+
+# |robust z| above which a sled is an outlier against its DBA or the fleet
+Z_LIMIT = 3.5
+
+# Smallest spread assumed per metric, so identical readings don't divide by zero
+MIN_SPREAD = {'current': 0.05, 'voltage': 0.05, 'temp': 1.0, 'temp_rate': 0.5}
+
+# Absolute limits on the rate of change between sweeps, per second
+TEMP_RATE_LIMIT = 1.0       # °C/s
+CURRENT_RATE_LIMIT = 2.0    # A/s
+
+# Allowed difference between summed DPM power and supply DC power, as a fraction of the supply power
+POWER_MISMATCH_LIMIT = 0.25
+
+MAD_TO_SIGMA = 1.4826
+
+# kind: 'current_spike', 'temp_high', 'temp_rising', 'voltage_sag', 'current_step' or 'power_mismatch'
+# address is the DPM or DTL address, None for fleet wide anomalies
+Anomaly = namedtuple('Anomaly', ['kind', 'address', 'value', 'score'])
+
+
+def robust_z(values, min_spread, axis=None):
+    """Robust z-score of each value against the others along axis, NaNs are ignored"""
+    with warnings.catch_warnings():
+        # nanmedian warns about a DBA with no readings, its scores just stay NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        median = np.nanmedian(values, axis=axis, keepdims=True)
+        mad = np.nanmedian(np.abs(values - median), axis=axis, keepdims=True)
+    return (values - median) / np.maximum(mad * MAD_TO_SIGMA, min_spread)
+
+
+class AnomalyDetector:
+    """Flags outlier sleds in sweep snapshots"""
+
+    def __init__(self, topology, z_limit=Z_LIMIT):
+        """Initializes an AnomalyDetector
+
+        Args:
+            topology: Topology the snapshots come from
+            z_limit: |robust z| above which a sled is flagged
+        """
+        self.z_limit = z_limit
+        # DBA x sled grids of addresses, padded where a DBA has fewer sleds
+        rows = len(topology.dbas)
+        columns = max(dba.sleds for dba in topology.dbas)
+        self.dpm_grid = np.zeros((rows, columns), dtype=np.int64)
+        self.dtl_grid = np.zeros((rows, columns), dtype=np.int64)
+        self.valid = np.zeros((rows, columns), dtype=bool)
+        for row, dba in enumerate(topology.dbas):
+            for slot in range(1, dba.sleds + 1):
+                self.dpm_grid[row, slot - 1] = topology.address(dba.cube, dba.dba, slot, ROLE_DPM)
+                self.dtl_grid[row, slot - 1] = topology.address(dba.cube, dba.dba, slot, ROLE_DTL)
+                self.valid[row, slot - 1] = True
+        # Last reading of each cell and its time, for the rates. Cells keep their own time
+        # since a sweep may read only the DPMs or only the DTLs
+        self._last = {metric: (np.full((rows, columns), np.nan), np.full((rows, columns), np.nan))
+                      for metric in ('current', 'temp')}
+
+    def _grid(self, addresses, readings, key):
+        """DBA x sled array of one reading, NaN where there is none"""
+        values = [np.nan if readings.get(address) is None else float(readings[address][key])
+                  for address in addresses.ravel()]
+        grid = np.array(values).reshape(addresses.shape)
+        grid[~self.valid] = np.nan
+        return grid
+
+    def _outliers(self, kind, values, addresses, min_spread, high=True):
+        """Anomalies for the sleds whose value is an outlier against their DBA or the fleet"""
+        z_dba = robust_z(values, min_spread, axis=1)
+        z_fleet = robust_z(values, min_spread)
+        with np.errstate(invalid='ignore'):
+            score = np.fmax(z_dba, z_fleet) if high else np.fmin(z_dba, z_fleet)
+            flagged = score > self.z_limit if high else score < -self.z_limit
+        return [Anomaly(kind, int(addresses[index]), float(values[index]), float(score[index]))
+                for index in zip(*np.nonzero(flagged & self.valid))]
+
+    def _rate(self, metric, values, now):
+        """Change per second of each cell since its last reading, NaN where either is missing"""
+        last_values, last_times = self._last[metric]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            elapsed = now - last_times
+            rate = np.where(elapsed > 0, (values - last_values) / elapsed, np.nan)
+        read = ~np.isnan(values)
+        self._last[metric] = (np.where(read, values, last_values), np.where(read, now, last_times))
+        return rate
+
+    def check(self, snapshot):
+        """Returns the list of Anomaly found in a sweep snapshot
+
+        Devices missing from the snapshot, or None in it, weren't read and are left out.
+        """
+        dpms, dtls = snapshot.get('dpm', dict()), snapshot.get('dtl', dict())
+        current = self._grid(self.dpm_grid, dpms, 'current')
+        voltage = self._grid(self.dpm_grid, dpms, 'voltage')
+        temp = self._grid(self.dtl_grid, dtls, 'temp')
+
+        anomalies = list()
+        anomalies += self._outliers('current_spike', current, self.dpm_grid, MIN_SPREAD['current'])
+        anomalies += self._outliers('voltage_sag', voltage, self.dpm_grid, MIN_SPREAD['voltage'], high=False)
+        anomalies += self._outliers('temp_high', temp, self.dtl_grid, MIN_SPREAD['temp'])
+
+        temp_rate = self._rate('temp', temp, snapshot['time'])
+        current_rate = self._rate('current', current, snapshot['time'])
+        anomalies += self._outliers('temp_rising', temp_rate, self.dtl_grid, MIN_SPREAD['temp_rate'])
+        with np.errstate(invalid='ignore'):
+            too_fast = (temp_rate > TEMP_RATE_LIMIT) & self.valid
+            stepped = (np.abs(current_rate) > CURRENT_RATE_LIMIT) & self.valid
+        flagged_rising = {anomaly.address for anomaly in anomalies if anomaly.kind == 'temp_rising'}
+        anomalies += [Anomaly('temp_rising', int(self.dtl_grid[index]), float(temp_rate[index]), None)
+                      for index in zip(*np.nonzero(too_fast))
+                      if int(self.dtl_grid[index]) not in flagged_rising]
+        anomalies += [Anomaly('current_step', int(self.dpm_grid[index]), float(current_rate[index]), None)
+                      for index in zip(*np.nonzero(stepped))]
+
+        anomalies += self.check_power(current, voltage, snapshot.get('supply', dict()))
+        return anomalies
+
+    def check_power(self, current, voltage, supplies):
+        """Compares the summed DPM power with the supplies' DC power"""
+        supply_power = [float(rsp['voltage']) * float(rsp['current']) for rsp in supplies.values() if rsp is not None]
+        if not supply_power or np.all(np.isnan(current)):
+            return list()
+        dpm_power = float(np.nansum(current * voltage))
+        total_supply = sum(supply_power)
+        if total_supply <= 0:
+            return list()
+        mismatch = (dpm_power - total_supply) / total_supply
+        if abs(mismatch) > POWER_MISMATCH_LIMIT:
+            return [Anomaly('power_mismatch', None, dpm_power, mismatch)]
+        return list()
+
+
+def describe(anomaly):
+    """One line description of an Anomaly for the output window"""
+    where = 'fleet' if anomaly.address is None else hex(anomaly.address)
+    score = '' if anomaly.score is None else ' (score {:.1f})'.format(anomaly.score)
+    return '{} {}: {:.2f}{}'.format(anomaly.kind, where, anomaly.value, score)
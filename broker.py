@@ -0,0 +1,490 @@
+##
+# Module with the CUBEMELTER broker
+#
+# The broker is the one process that owns the CAN channels. It polls the present devices
+# once per interval, no matter how many clients are watching, and pushes each snapshot to
+# every subscribed client. Clients (the GUI with --broker, the command line below, test
+# scripts using BrokerClient) send their commands through it.
+#
+# The protocol is json, one message per line, over a local TCP socket:
+#   client -> broker  {"id": 1, "op": "call", "method": "set_fets_batch", "args": [{"128": [2, 4]}]}
+#   broker -> client  {"id": 1, "result": ...}  or  {"id": 1, "error": "..."}
+#   broker -> client  {"event": "snapshot", "data": {...}}  (after "subscribe")
+#
+# Each snapshot carries the anomalies (see anomaly.py) found in it under "anomalies".
+#
+# Client calls run on their connections' threads alongside the polling sweep. Their sync
+# requests share the channel lock in cube_ops, so only one is on a channel at a time.
+#
+# Usage:
+#   python broker.py serve [--topology FILE] [--port PORT] [--interval SECONDS]
+#   python broker.py call set_fets_batch '{"0x80": [2, 4]}'
+#   python broker.py watch
+#   python broker.py call read_dtl_env 0x80 2 5     (timeout 2s, accept a reading up to 5s old)
+#   python broker.py cache_stats
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+from spectracan import ChannelManager
+
+from anomaly import AnomalyDetector, describe
+from cube_ops import CubeOps, CHANNELS, DtlReadback, FetResult, setup_channel
+from log_pipeline import setup_logging, LOG_FORMATS
+from pacing import PacingProfile, PACING_PATH
+from topology import Topology, TOPOLOGY_FILE, ROLE_DPM, ROLE_DTL
+
+LOG_NAME = 'CUBEMELTER_broker.log'
+
+BROKER_HOST = '127.0.0.1'
+BROKER_PORT = 5757
+
+# Seconds between sweeps while at least one client is subscribed
+POLL_INTERVAL = 1.0
+
+# Seconds a client waits for the broker to answer a request
+CLIENT_TIMEOUT = 30
+
+# Messages queued for a client before it counts as not reading and is disconnected
+OUTBOUND_QUEUE_SIZE = 64
+
+# CubeOps methods the clients are allowed to call
+BROKER_METHODS = ('enable_dpm', 'disable_dpm', 'set_dtl_fets', 'set_fets_batch',
+                  'read_dpm_env', 'read_dtl', 'read_dtl_env', 'read_dtl_fets', 'read_dtl_fets_many', 'read_supply_env')
+
+
+class BrokerError(Exception):
+    """Raised by BrokerClient when the broker reports an error"""
+
+
+def encode(message):
+    return (json.dumps(message, default=_json_default) + '\n').encode()
+
+
+def decode(line):
+    return json.loads(line, object_hook=_int_keys)
+
+
+def _json_default(obj):
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj)
+    return str(obj)
+
+
+def _int_keys(obj):
+    """json turns the int address keys into strings, turn them back"""
+    return {_parse_key(key): value for key, value in obj.items()}
+
+
+def _parse_key(key):
+    try:
+        return int(key, 0)
+    except ValueError:
+        return key
+
+
+class CubeBroker:
+    """Owns the CubeOps, runs the acquisition loop and serves the clients"""
+
+    def __init__(self, ops, topology, host=BROKER_HOST, port=BROKER_PORT, poll_interval=POLL_INTERVAL):
+        self.logger = logging.getLogger(__name__)
+        self.ops = ops
+        self.topology = topology
+        self.poll_interval = poll_interval
+        self.detector = AnomalyDetector(topology)
+        self.latest = None
+        self.stop = threading.Event()
+        self._clients = set()
+        self._clients_lock = threading.Lock()
+        self._sweep_done = threading.Condition()
+        self._sweeping = False
+        self._sweeps = 0            # sweeps finished, successful or not
+        self._sweep_error = None
+        self.server = _BrokerServer((host, port), _ClientHandler)
+        self.server.broker = self
+
+    def serve_forever(self):
+        """Scans for devices, then serves clients until shutdown() is called"""
+        self.scan()
+        acquisition = threading.Thread(target=self._acquisition_loop, name='acquisition', daemon=True)
+        acquisition.start()
+        self.logger.info('Broker listening on %s:%s', *self.server.server_address)
+        try:
+            self.server.serve_forever()
+        finally:
+            self.stop.set()
+            self.server.server_close()
+
+    def shutdown(self):
+        self.stop.set()
+        self.server.shutdown()
+
+    def scan(self):
+        """Finds the present devices and tells the clients"""
+        responders = self.ops.scan([device.address for device in self.topology.devices])
+        self.topology.clear_present()
+        for address in responders:
+            self.topology.mark_present(address)
+        present = self.topology.present()
+        self.logger.info('Scan found %d devices', len(present))
+        self.publish({'event': 'present', 'data': present})
+        return present
+
+    def sweep(self):
+        """Sweeps the present devices and publishes the snapshot
+
+        A caller that arrives while a sweep is running gets that sweep's snapshot (or its
+        error) instead of starting another one.
+        """
+        with self._sweep_done:
+            if self._sweeping:
+                sweeps = self._sweeps
+                while self._sweeps == sweeps:
+                    self._sweep_done.wait()
+                if self._sweep_error is not None:
+                    raise self._sweep_error
+                return self.latest
+            self._sweeping = True
+
+        error = None
+        try:
+            snapshot = self.ops.sweep(self.topology.present(ROLE_DPM), self.topology.present(ROLE_DTL),
+                                      self.topology.supplies.values())
+            anomalies = self.detector.check(snapshot)
+            for anomaly in anomalies:
+                self.logger.warning('Anomaly: %s', describe(anomaly))
+            snapshot['anomalies'] = [anomaly._asdict() for anomaly in anomalies]
+            self.latest = snapshot
+        except Exception as err:
+            error = err
+            raise
+        finally:
+            with self._sweep_done:
+                self._sweeping = False
+                self._sweep_error = error
+                self._sweeps += 1
+                self._sweep_done.notify_all()
+        self.publish({'event': 'snapshot', 'data': snapshot})
+        return snapshot
+
+    def _acquisition_loop(self):
+        while not self.stop.is_set():
+            started = time.monotonic()
+            if any(client.subscribed for client in list(self._clients)):
+                try:
+                    self.sweep()
+                except Exception:  # pylint: disable=broad-except
+                    self.logger.exception('Sweep failed')
+            self.stop.wait(max(0.0, self.poll_interval - (time.monotonic() - started)))
+
+    def publish(self, message):
+        """Queues a message for every subscribed client, never waits on a slow one"""
+        data = encode(message)
+        for client in list(self._clients):
+            if client.subscribed:
+                client.push(data)
+
+    def add_client(self, client):
+        with self._clients_lock:
+            self._clients.add(client)
+
+    def remove_client(self, client):
+        with self._clients_lock:
+            self._clients.discard(client)
+
+    def handle(self, client, message):
+        """Runs one client request and returns its result"""
+        op = message.get('op')
+        if op == 'subscribe':
+            client.subscribed = True
+            return self.latest
+        if op == 'unsubscribe':
+            client.subscribed = False
+            return None
+        if op == 'call':
+            method = message.get('method')
+            if method not in BROKER_METHODS:
+                raise ValueError('Unknown method: {}'.format(method))
+            return getattr(self.ops, method)(*message.get('args', []), **message.get('kwargs', dict()))
+        if op == 'scan':
+            return self.scan()
+        if op == 'present':
+            return self.topology.present()
+        if op == 'snapshot':
+            return self.latest
+        if op == 'sweep':
+            return self.sweep()
+        if op == 'cache_stats':
+            return self.ops.cache.snapshot_stats()
+        raise ValueError('Unknown op: {}'.format(op))
+
+
+class _BrokerServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _ClientHandler(socketserver.StreamRequestHandler):
+    """One connected client
+
+    Everything sent to the client goes through a bounded queue drained by its own writer
+    thread, so a client that stops reading only holds up itself. A subscriber whose queue
+    fills up is disconnected.
+    """
+
+    def setup(self):
+        super().setup()
+        self.subscribed = False
+        self._outbound = queue.Queue(OUTBOUND_QUEUE_SIZE)
+        self._writer = threading.Thread(target=self._write_loop, name='broker_writer', daemon=True)
+        self._writer.start()
+        self.server.broker.add_client(self)
+
+    def finish(self):
+        self.server.broker.remove_client(self)
+        try:
+            self._outbound.put_nowait(None)
+        except queue.Full:
+            pass  # the writer is stuck on the socket, closing it below ends the writer
+        super().finish()
+
+    def _write_loop(self):
+        while True:
+            data = self._outbound.get()
+            if data is None:
+                return
+            try:
+                self.wfile.write(data)
+                self.wfile.flush()
+            except OSError:
+                self.subscribed = False
+                return
+
+    def write(self, data):
+        """Queues a reply, waiting up to CLIENT_TIMEOUT for room"""
+        try:
+            self._outbound.put(data, timeout=CLIENT_TIMEOUT)
+        except queue.Full:
+            self.server.broker.logger.warning('Dropped a reply to %s, it is not reading', self.client_address)
+
+    def push(self, data):
+        """Queues a pushed message, a client that has fallen OUTBOUND_QUEUE_SIZE messages behind is dropped"""
+        try:
+            self._outbound.put_nowait(data)
+        except queue.Full:
+            self.subscribed = False
+            self.server.broker.logger.warning('Disconnecting %s, it stopped reading', self.client_address)
+            try:
+                self.connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def handle(self):
+        broker = self.server.broker
+        for line in self.rfile:
+            try:
+                message = decode(line)
+            except ValueError as err:
+                self.write(encode({'error': 'Bad message: {}'.format(err)}))
+                continue
+            # Requests run on their own thread so a long scan doesn't hold up this client's other requests
+            threading.Thread(target=self._respond, args=(broker, message), daemon=True).start()
+
+    def _respond(self, broker, message):
+        try:
+            reply = {'id': message.get('id'), 'result': broker.handle(self, message)}
+        except Exception as err:  # pylint: disable=broad-except
+            broker.logger.info('Request %s failed: %s', message, err)
+            reply = {'id': message.get('id'), 'error': str(err)}
+        self.write(encode(reply))
+
+
+class BrokerClient:
+    """Connection to a CubeBroker"""
+
+    def __init__(self, host=BROKER_HOST, port=BROKER_PORT, timeout=CLIENT_TIMEOUT):
+        self.timeout = timeout
+        self._sock = socket.create_connection((host, port))
+        self._rfile = self._sock.makefile('rb')
+        self._ids = itertools.count(1)
+        self._pending = dict()  # {int id : [Event, reply]}
+        self._lock = threading.Lock()
+        self._callbacks = list()
+        self._reader = threading.Thread(target=self._read_loop, name='broker_client', daemon=True)
+        self._reader.start()
+
+    def close(self):
+        self._sock.close()
+
+    def request(self, op, **fields):
+        """Sends a request and waits for its result
+
+        Raises:
+            BrokerError if the broker reports an error or doesn't answer in time
+        """
+        request_id = next(self._ids)
+        waiter = [threading.Event(), None]
+        with self._lock:
+            self._pending[request_id] = waiter
+            self._sock.sendall(encode(dict(fields, id=request_id, op=op)))
+        if not waiter[0].wait(self.timeout):
+            with self._lock:
+                self._pending.pop(request_id, None)
+            raise BrokerError('No answer from the broker to ' + op)
+        reply = waiter[1]
+        if 'error' in reply:
+            raise BrokerError(reply['error'])
+        return reply.get('result')
+
+    def call(self, method, *args, **kwargs):
+        """Calls a CubeOps method on the broker"""
+        return self.request('call', method=method, args=list(args), kwargs=kwargs)
+
+    def subscribe(self, callback):
+        """Registers callback(event, data) for pushed messages, returns the latest snapshot
+
+        The callback runs on the client's reader thread.
+        """
+        self._callbacks.append(callback)
+        return self.request('subscribe')
+
+    def _read_loop(self):
+        for line in self._rfile:
+            message = decode(line)
+            if 'event' in message:
+                for callback in self._callbacks:
+                    callback(message['event'], message['data'])
+                continue
+            with self._lock:
+                waiter = self._pending.pop(message.get('id'), None)
+            if waiter is not None:
+                waiter[1] = message
+                waiter[0].set()
+
+
+class RemoteCubeOps:
+    """Same interface as CubeOps, with every operation going through a broker"""
+
+    def __init__(self, client, pacing=None):
+        self.client = client
+        self.pacing = pacing or PacingProfile.load()
+
+    def close(self):
+        self.client.close()
+
+    def enable_dpm(self, dpm_address):
+        self.client.call('enable_dpm', dpm_address)
+
+    def disable_dpm(self, dpm_address):
+        self.client.call('disable_dpm', dpm_address)
+
+    def set_dtl_fets(self, dtl_address, fets_5, fets_12):
+        self.client.call('set_dtl_fets', dtl_address, fets_5, fets_12)
+
+    def read_dpm_env(self, dpm_address, *args):
+        return self.client.call('read_dpm_env', dpm_address, *args)
+
+    def read_dtl(self, dtl_address, *args):
+        return DtlReadback(*self.client.call('read_dtl', dtl_address, *args))
+
+    def read_dtl_env(self, dtl_address, *args):
+        return tuple(self.client.call('read_dtl_env', dtl_address, *args))
+
+    def read_dtl_fets(self, dtl_address, *args):
+        return tuple(self.client.call('read_dtl_fets', dtl_address, *args))
+
+    def read_dtl_fets_many(self, dtl_addresses, *args):
+        readback = self.client.call('read_dtl_fets_many', list(dtl_addresses), *args)
+        return {address: None if fets is None else tuple(fets) for address, fets in readback.items()}
+
+    def read_supply_env(self, supply_lun, *args):
+        return self.client.call('read_supply_env', supply_lun, *args)
+
+    def set_fets_batch(self, targets, **kwargs):
+        report = self.client.call('set_fets_batch', targets, **kwargs)
+        return {address: FetResult(status, tuple(requested), None if applied is None else tuple(applied), attempts)
+                for address, (status, requested, applied, attempts) in report.items()}
+
+    def scan(self, addresses=None, listening_time=None):
+        """The broker scans every address in its topology"""
+        return set(self.client.request('scan'))
+
+    def sweep(self, *args, **kwargs):
+        """The broker sweeps the devices it found present"""
+        return self.client.request('sweep')
+
+
+def _parse_arg(text):
+    """Command line arguments are json, or ints like 0x80"""
+    try:
+        return int(text, 0)
+    except ValueError:
+        return decode(text)
+
+
+def main():
+    """Run the broker, or talk to a running one"""
+    parser = argparse.ArgumentParser(description='CUBEMELTER broker')
+    parser.add_argument('--host', default=BROKER_HOST)
+    parser.add_argument('--port', type=int, default=BROKER_PORT)
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    parser.add_argument('--log-format', default='text', choices=LOG_FORMATS)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    serve = commands.add_parser('serve', help='own the CAN channels and serve clients')
+    serve.add_argument('--topology', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                          TOPOLOGY_FILE))
+    serve.add_argument('--pacing', default=PACING_PATH, help='calibrated pacing profile (default: %(default)s)')
+    serve.add_argument('--interval', type=float, default=POLL_INTERVAL, help='seconds between sweeps')
+
+    call = commands.add_parser('call', help='call a CubeOps method: ' + ', '.join(BROKER_METHODS))
+    call.add_argument('method', choices=BROKER_METHODS)
+    call.add_argument('args', nargs='*', type=_parse_arg)
+
+    for op in ('scan', 'present', 'snapshot', 'sweep', 'cache_stats'):
+        commands.add_parser(op)
+    commands.add_parser('watch', help='print every snapshot the broker publishes')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        log_listener = setup_logging(LOG_NAME, args.log_level, args.log_format)
+        topology = Topology.load(args.topology)
+        for channel_num in CHANNELS:
+            setup_channel(channel_num)
+        broker = CubeBroker(CubeOps(pacing=PacingProfile.load(args.pacing)), topology, args.host, args.port, args.interval)
+        try:
+            broker.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            ChannelManager.shutdown_channels()
+            log_listener.stop()
+        return
+
+    client = BrokerClient(args.host, args.port)
+    if args.command == 'call':
+        result = client.call(args.method, *args.args)
+    elif args.command == 'watch':
+        client.subscribe(lambda event, data: print(json.dumps({event: data}, default=_json_default), flush=True))
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            return
+    else:
+        result = client.request(args.command)
+    json.dump(result, sys.stdout, default=_json_default, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
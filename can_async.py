@@ -0,0 +1,253 @@
+##
+# Module with an asyncio transport over MsgSender and SpectraListener
+#
+# Requests run on a worker pool so they can be awaited and gathered, e.g.
+#
+#   transport = AsyncTransport()
+#   cube = AsyncCubeOps(CubeOps(), transport)
+#   temps, fets, supply = await asyncio.gather(cube.read_dtl_env(0x80),
+#                                              cube.set_fets_batch({0x81: (2, 4)}),
+#                                              cube.read_supply_env(0x01))
+#
+# Sync requests take their channel's lock from cube_ops, the same one CubeOps requests take,
+# so only one is on a channel at a time. Requests on different channels, and commands that
+# have no response, still run side by side.
+#
+# Each call holds one of its channel's slots until its worker thread is done with the bus,
+# even if the caller stopped waiting. Batched operations (set_fets_batch, read_dtl) run on
+# one worker and hold one slot; the frames inside them are paced by the PacingProfile, not
+# by the slot limit.
+#
+# The asyncio objects are made on the loop that first uses them, so an AsyncTransport can be
+# built before asyncio.run. Needs Python 3.7+.
+
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from spectracan import MsgSender
+from spectracan.spectra_listener import SpectraListener
+
+from cube_ops import CNUM_CANR, CNUM_CANT, SRC_ADDRESS, REQUEST_TIMEOUT, channel_lock
+
+# Calls allowed on a channel's workers before callers have to wait
+MAX_IN_FLIGHT = 16
+
+# Frames buffered by a FrameStream before the oldest are dropped
+FRAME_QUEUE_SIZE = 1024
+
+# How long a FrameStream listens when no timeout is given
+LISTEN_FOREVER = 24 * 60 * 60
+
+
+class AsyncTransport:
+    """Awaitable request/response and frame streams for the channels set up by ChannelManager"""
+
+    def __init__(self, channels=(CNUM_CANR, CNUM_CANT), max_in_flight=MAX_IN_FLIGHT, src=SRC_ADDRESS):
+        """Initializes an AsyncTransport
+
+        Args:
+            channels: Channel numbers that have been set up with ChannelManager
+            max_in_flight: Calls allowed per channel, further callers wait for a slot
+            src: Address the commands are sent from
+        """
+        self.logger = logging.getLogger(__name__)
+        self.src = src
+        self.max_in_flight = max_in_flight
+        self._channels = tuple(channels)
+        self._loop = None
+        self._slots = dict()
+        self._in_flight = {channel_num: 0 for channel_num in channels}
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight * len(channels),
+                                            thread_name_prefix='can_async')
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    def in_flight(self, channel_num):
+        """Number of calls on the channel whose worker is still running, timed out ones included"""
+        return self._in_flight[channel_num]
+
+    def _slot(self, channel_num):
+        """The channel's semaphore, made on the running loop as before 3.10 they belong to the loop they're made on"""
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._slots = {channel: asyncio.Semaphore(self.max_in_flight) for channel in self._channels}
+            self._in_flight = {channel: 0 for channel in self._channels}
+        return self._slots[channel_num]
+
+    def _finished(self, channel_num):
+        """Frees the slot of a call once its worker is done, runs on the event loop"""
+        self._in_flight[channel_num] -= 1
+        self._slots[channel_num].release()
+
+    async def run(self, channel_num, func, *args, timeout=REQUEST_TIMEOUT, **kwargs):
+        """Runs a blocking bus call once the channel has a free slot
+
+        The deadline covers the wait for a slot as well as the call itself. A call that
+        misses the deadline keeps its slot until its worker returns, so the slot limit
+        still bounds what is on the bus.
+
+        Raises:
+            asyncio.TimeoutError if the deadline passes
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        slot = self._slot(channel_num)
+        await asyncio.wait_for(slot.acquire(), timeout)
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            slot.release()
+            raise asyncio.TimeoutError()
+        self._in_flight[channel_num] += 1
+
+        def call():
+            try:
+                return func(*args, **kwargs)
+            finally:
+                try:
+                    loop.call_soon_threadsafe(self._finished, channel_num)
+                except RuntimeError:
+                    pass  # the loop has closed, nobody is left to wait for the slot
+
+        # Shielded so a timeout doesn't cancel a call that hasn't started, which would never free its slot
+        return await asyncio.wait_for(asyncio.shield(loop.run_in_executor(self._executor, call)), remaining)
+
+    async def request(self, dest, command, channel_num=CNUM_CANT, timeout=REQUEST_TIMEOUT):
+        """Sends a command and returns the response bytes"""
+        # MsgSender gets the same timeout so the worker doesn't outlive the deadline by much
+        return await self.run(channel_num, self._request_sync, dest, command, channel_num, timeout,
+                              timeout=timeout)
+
+    async def send(self, dest, command, channel_num=CNUM_CANT, timeout=REQUEST_TIMEOUT):
+        """Sends a command that has no response"""
+        await self.run(channel_num, self._send_sync, dest, command, channel_num, timeout=timeout)
+
+    def _send_sync(self, dest, command, channel_num):
+        MsgSender.send_command_no_response(channel_num=channel_num,
+                                           src=self.src,
+                                           dest=dest,
+                                           command=command)
+
+    def _request_sync(self, dest, command, channel_num, timeout):
+        with channel_lock(channel_num):
+            return MsgSender.send_command_sync(channel_num=channel_num,
+                                              src=self.src,
+                                              dest=dest,
+                                              command=command,
+                                              timeout=timeout)
+
+    def frames(self, channel_num=CNUM_CANT, timeout=None, queue_size=FRAME_QUEUE_SIZE):
+        """Returns a FrameStream of the frames received on a channel"""
+        return FrameStream(channel_num, timeout, queue_size)
+
+
+class FrameStream:
+    """Async iterator over the frames a SpectraListener receives
+
+    Use as `async with transport.frames(CNUM_CANT) as frames: async for frame in frames: ...`
+    The stream ends when the timeout expires or the context exits. If the consumer
+    falls behind the oldest frames are dropped and counted in `dropped`.
+    """
+
+    def __init__(self, channel_num, timeout=None, queue_size=FRAME_QUEUE_SIZE):
+        self.channel_num = channel_num
+        self.timeout = timeout
+        self.dropped = 0
+        self.queue_size = queue_size
+        self._queue = None
+        self._loop = None
+        self._listener = None
+        self._done = object()
+
+    async def __aenter__(self):
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._listener = SpectraListener(self.channel_num)
+        self._listener.start_frame_consumer(frame_callback=self._on_frame,
+                                            timeout=self.timeout or LISTEN_FOREVER,
+                                            timeout_callback=self._on_timeout)
+        self._listener.start_timer.set()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._listener.stop = True
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        frame = await self._queue.get()
+        if frame is self._done:
+            raise StopAsyncIteration
+        return frame
+
+    def _put(self, item):
+        if self._queue.full():
+            self._queue.get_nowait()
+            self.dropped += 1
+        self._queue.put_nowait(item)
+
+    def _on_frame(self, frame):
+        """Called on the listener's thread"""
+        self._loop.call_soon_threadsafe(self._put, frame)
+
+    def _on_timeout(self):
+        """Called on the listener's thread"""
+        self._loop.call_soon_threadsafe(self._put, self._done)
+
+
+class AsyncCubeOps:
+    """Awaitable versions of the CubeOps operations, paced by an AsyncTransport"""
+
+    def __init__(self, ops, transport):
+        self.ops = ops
+        self.transport = transport
+
+    async def read_dpm_env(self, dpm_address, timeout=REQUEST_TIMEOUT):
+        return await self.transport.run(self.ops.channel_t, self.ops.read_dpm_env, dpm_address,
+                                        timeout, timeout=timeout)
+
+    async def read_dtl_env(self, dtl_address, timeout=REQUEST_TIMEOUT):
+        return await self.transport.run(self.ops.channel_t, self.ops.read_dtl_env, dtl_address,
+                                        timeout, timeout=timeout)
+
+    async def read_dtl_fets(self, dtl_address, timeout=REQUEST_TIMEOUT):
+        return await self.transport.run(self.ops.channel_t, self.ops.read_dtl_fets, dtl_address,
+                                        timeout, timeout=timeout)
+
+    async def read_dtl(self, dtl_address, timeout=REQUEST_TIMEOUT):
+        """CubeOps.read_dtl, both halves on one worker holding one slot"""
+        return await self.transport.run(self.ops.channel_t, self.ops.read_dtl, dtl_address,
+                                        timeout, timeout=timeout)
+
+    async def read_supply_env(self, supply_lun, timeout=REQUEST_TIMEOUT):
+        return await self.transport.run(self.ops.channel_r, self.ops.read_supply_env, supply_lun,
+                                        timeout, timeout=timeout)
+
+    async def enable_dpm(self, dpm_address):
+        await self.transport.run(self.ops.channel_t, self.ops.enable_dpm, dpm_address)
+
+    async def disable_dpm(self, dpm_address):
+        await self.transport.run(self.ops.channel_t, self.ops.disable_dpm, dpm_address)
+
+    async def set_dtl_fets(self, dtl_address, fets_5, fets_12):
+        await self.transport.run(self.ops.channel_t, self.ops.set_dtl_fets, dtl_address, fets_5, fets_12)
+
+    async def set_fets_batch(self, targets, timeout=REQUEST_TIMEOUT, **kwargs):
+        """CubeOps.set_fets_batch on one worker holding one slot, its frames are paced by the PacingProfile"""
+        return await self.transport.run(self.ops.channel_t, self.ops.set_fets_batch, targets,
+                                        timeout=timeout, **kwargs)
+
+    async def gather_reads(self, read, addresses, timeout=REQUEST_TIMEOUT):
+        """Runs `read` for every address at once, their sync requests still take turns on the channel
+
+        Returns {address: result}, with the exception as the result for the ones that failed
+        """
+        started = time.monotonic()
+        results = await asyncio.gather(*(read(address, timeout) for address in addresses),
+                                       return_exceptions=True)
+        self.transport.logger.debug('Read %d devices in %.3fs', len(results), time.monotonic() - started)
+        return dict(zip(addresses, results))
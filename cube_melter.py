@@ -2,9 +2,12 @@
 ##
 # Module with the CUBEMELTER Tool
 
+import argparse
 import logging
 import os
+import queue
 import re
+import sys
 from datetime import datetime
 
 # linters might not like these, but pyinstaller needs 'em
@@ -14,14 +17,10 @@ import pycan.interfaces.usb2can         # noqa # pylint: disable=unused-import
 
 import time
 import math
-from logging.handlers import RotatingFileHandler
 
-from spectracan import ChannelManager, MsgSender
-from spectracan.can_commands import (LCFCmd_HeartBeat, PMM_DeviceEnableCmd, PMM_DeviceDisableCmd,
-                                     LCFCmd_GetEnvironment, CanCommand)
+from spectracan import ChannelManager
 
 from spectracan.error import CanTimeoutError, ChannelNotSetUpError
-from spectracan.can_enums import LcfAddress
 
 from pycan.interfaces.kvaser.canlib import CANLIBError
 
@@ -30,35 +29,40 @@ from tkinter import (Tk, Button, LabelFrame, Label, Text, Entry, BooleanVar, Int
 
 from spectracan.spectra_listener import SpectraListener
 
-from AddressDictionary import AddressDictionary, SupplyLUN
+from topology import Topology, TOPOLOGY_FILE, ROLE_DPM, ROLE_DTL
+from broker import BrokerClient, RemoteCubeOps, BROKER_HOST, BROKER_PORT
+from log_pipeline import setup_logging, fields, LOG_FORMATS
+from pacing import PacingProfile, KIND_ENV, KIND_DTL_ENV, KIND_DPM_POWER, PACING_PATH
+from anomaly import AnomalyDetector, Anomaly, describe
+from power_control import PowerController, REACHED, LIMITED_BY_SUPPLY
+from cube_ops import CubeOps, CNUM_CANR, CNUM_CANT, SRC_ADDRESS, FET_APPLIED, DTL_MAX_TEMP
 
 LOG_NAME = 'CUBEMELTER.log'
 VERSION = '1.0.0'
 
-CNUM_CANR = 0
-CNUM_CANT = 1
-
-SRC_ADDRESS = LcfAddress.CAN_OPENER.value
-PMM_ADDRESS = LcfAddress.PCM_PMM_MAIN.value
-
 # Time in seconds to wait for heartbeat responses during the scan
 LISTENING_TIME = 3
 
+# Milliseconds between checks for snapshots pushed by the broker
+BROKER_POLL_MS = 200
+
 # status byte of CAN commands
 GOOD_STATUS = '0'
 
-DTL_MAX_TEMP = 90
-
 class CUBEMELTER:
     """Class that implements the CUBEMELTER tool"""
 
-    def __init__(self, root):
+    def __init__(self, root, topology, broker_client=None, pacing=None):
         """Initializes a CUMEMELTER object
 
         Args:
             root: Root of the Tkinter display
+            topology: Topology of the cube(s) being tested
+            broker_client: BrokerClient to send everything through, instead of owning the CAN channels
+            pacing: PacingProfile for the bulk operations
         """
         self.logger = logging.getLogger(__name__)
+        self.topology = topology
         self.logger.info('Creating CUBMELTER display')
 
         root.title(f'CUBEMELTER {VERSION}')
@@ -97,16 +101,28 @@ class CUBEMELTER:
         self.dict_supply_dc = dict()        # {int supplyLUN : IntVar supply_dc}
         self.dtl_cont_stop = False
         self.dpm_cont_stop = False
+        self.broker_client = broker_client
+        self.ops = CubeOps(pacing=pacing) if broker_client is None else RemoteCubeOps(broker_client, pacing)
+        self.broker_events = queue.Queue()
+        self.detector = AnomalyDetector(topology)
 
         # Create the GUI using the tkinter grid layout manager
 
-        for dba_num in [1, 2, 3, 4]:
-            self.create_dba_frame(root, dba_num)
+        for row, dba in enumerate(self.topology.dbas):
+            self.create_dba_frame(root, row, dba)
 
         self.create_scan_frame(root)
         self.create_supply_frame(root)
         self.create_output_frame(root)
 
+        if self.broker_client is not None:
+            # The broker owns the channels, it pushes its snapshots to us
+            self.log_to_output("Using the broker for CAN")
+            self.can_ready = True
+            self.broker_client.subscribe(lambda event, data: self.broker_events.put((event, data)))
+            root.after(BROKER_POLL_MS, self.poll_broker_events, root)
+            return
+
         # Set up channel manager
         self.can_ready = self.setup_can_channels()
 
@@ -130,12 +146,16 @@ class CUBEMELTER:
 
         return True
 
-    def create_dba_frame(self, root, dba_num):
+    def create_dba_frame(self, root, row, dba):
         """Creates each DBA Frame"""
         # DBA Frame
+        dba_num = dba.dba
         self.logger.info('Creating DBA Frame {}'.format(dba_num))
-        self.frame_dba = LabelFrame(root, text="DBA{}".format(dba_num), labelanchor='w')
-        self.frame_dba.grid(row=dba_num-1, column=0, sticky='nsew')
+        label = "DBA{}".format(dba_num)
+        if len(set(each.cube for each in self.topology.dbas)) > 1:
+            label = "{} {}".format(dba.cube, label)
+        self.frame_dba = LabelFrame(root, text=label, labelanchor='w')
+        self.frame_dba.grid(row=row, column=0, sticky='nsew')
 
         # DPM? Label
         lbl_dpm_present = Label(self.frame_dba, text='DPM?')
@@ -162,15 +182,15 @@ class CUBEMELTER:
         lbl_mfg_date = Label(self.frame_dba, text='12VFetSet')
         lbl_mfg_date.grid(row=0, column=10)
 
-        for i in range(1, 9):
+        for i in range(1, dba.sleds + 1):
             # Sled Label
             lbl_mfg_date = Label(self.frame_dba, text='Sled{}'.format(i))
             lbl_mfg_date.grid(row=i, column=0)
 
-            # Use CANAddresses for dict keys, look it up in AddressDictionary
-            dtl_address = AddressDictionary["DBA{}_DTL{}".format(dba_num, i)]
-            dpm_address = AddressDictionary["DBA{}_DPM{}".format(dba_num, i)]
-            self.logger.info('dtl_address:{} dpm_address:{}'.format(dtl_address, dpm_address))
+            # Use CANAddresses for dict keys, look it up in the topology
+            dtl_address = self.topology.address(dba.cube, dba_num, i, ROLE_DTL)
+            dpm_address = self.topology.address(dba.cube, dba_num, i, ROLE_DPM)
+            self.logger.debug('dtl_address:%s dpm_address:%s', dtl_address, dpm_address)
 
             # DPM CheckBox
             dpm_check_var = BooleanVar()
@@ -337,13 +357,11 @@ class CUBEMELTER:
         lbl_supply_dc = Label(frame_supply, text='DC(W)')
         lbl_supply_dc.grid(row=2, column=8)
 
-        for supply_num in [0,1,2]:
+        for supply_num, (supply_name, supply_lun) in enumerate(self.topology.supplies.items()):
             # Supply Label
-            lbl_supply_num = Label(frame_supply, text='Supply{}'.format(supply_num))
+            lbl_supply_num = Label(frame_supply, text=supply_name)
             lbl_supply_num.grid(row=3+supply_num, column=0)
 
-            supply_lun = SupplyLUN["Supply{}".format(supply_num)]
-
             # Get Button
             btn_get_supply_env = Button(frame_supply, text='GET',
                                         command=lambda lun=supply_lun:
@@ -399,37 +417,63 @@ class CUBEMELTER:
             ent_supply_dc.grid(row=3 + supply_num, column=8)
             self.dict_supply_dc.update({supply_lun: supply_dc})
 
+        # Controls go below the last supply
+        row = 4 + max(3, len(self.topology.supplies))
+
         # Total DPM Power Label
         lbl_total_dpm_power = Label(frame_supply, text='Total DPM Power:')
-        lbl_total_dpm_power.grid(row=7, column=1)
+        lbl_total_dpm_power.grid(row=row, column=1)
 
         # Total DPM Power Box
         self.total_dpm_power = DoubleVar()
         ent_total_dpm_power = Entry(frame_supply, background='white', width=9, textvariable=self.total_dpm_power)
         ent_total_dpm_power.configure(state='disabled')
-        ent_total_dpm_power.grid(row =7,column=2)
+        ent_total_dpm_power.grid(row=row, column=2)
 
         # All 5V Label
         lbl_all_twelve = Label(frame_supply, text='All 5:')
-        lbl_all_twelve.grid(row=8, column=1)
+        lbl_all_twelve.grid(row=row+1, column=1)
 
         # All 5 Box
         self.all_fets_five = IntVar()
         ent_all_fets_five = Entry(frame_supply, background='white', width=3, textvariable=self.all_fets_five)
-        ent_all_fets_five.grid(row=8, column=2)
+        ent_all_fets_five.grid(row=row+1, column=2)
 
         # All 12V Label
         lbl_all_twelve = Label(frame_supply, text='All 12:')
-        lbl_all_twelve.grid(row=8, column=3)
+        lbl_all_twelve.grid(row=row+1, column=3)
 
         # All 12 Box
         self.all_fets_twelve = IntVar()
         ent_all_fets_twelve = Entry(frame_supply, background='white', width=3, textvariable=self.all_fets_twelve)
-        ent_all_fets_twelve.grid(row=8, column=4)
+        ent_all_fets_twelve.grid(row=row+1, column=4)
 
         # Set all fets button
         self.btn_set_all_fets = Button(frame_supply, text='SET ALL FETS', height=2, width=16, command=self.set_all_fets)
-        self.btn_set_all_fets.grid(row=9, column=1, rowspan=2)
+        self.btn_set_all_fets.grid(row=row+2, column=1, rowspan=2)
+
+        # Target Power Label
+        lbl_target_power = Label(frame_supply, text='Target W:')
+        lbl_target_power.grid(row=row+1, column=5)
+
+        # Target Power Box
+        self.target_power = DoubleVar()
+        ent_target_power = Entry(frame_supply, background='white', width=6, textvariable=self.target_power)
+        ent_target_power.grid(row=row+1, column=6)
+
+        # Supply Limit Label
+        lbl_supply_limit = Label(frame_supply, text='Supply max W:')
+        lbl_supply_limit.grid(row=row+1, column=7)
+
+        # Supply Limit Box, 0 for no limit
+        self.supply_limit = DoubleVar()
+        ent_supply_limit = Entry(frame_supply, background='white', width=6, textvariable=self.supply_limit)
+        ent_supply_limit.grid(row=row+1, column=8)
+
+        # Go to target power button
+        self.btn_target_power = Button(frame_supply, text='GO TO TARGET', height=2, width=16,
+                                       command=self.go_to_power_target)
+        self.btn_target_power.grid(row=row+2, column=5, rowspan=2, columnspan=3)
 
     def create_output_frame(self, root):
         """Creates the Output frame where Users can see live output of what is happening"""
@@ -449,22 +493,15 @@ class CUBEMELTER:
         self.lbox_output.config(yscrollcommand=vsb.set)
         vsb.config(command=self.lbox_output.yview)
 
-    def send_heartbeat(self, address):
-        command = LCFCmd_HeartBeat.build_command()
-
-        MsgSender.send_command_no_response(channel_num=CNUM_CANT,
-                                           src=SRC_ADDRESS,
-                                           dest=address,
-                                           command=command)
-
     def frame_handler(self, frame):
         """Callback given to SpectraListener.
         Receives a CanFrame, if it is the first heartbeat response from a given address add it to the treeview"""
         # TODO: Improve / Test the check here, maybe use spectracan.cli.parser to do some of the heavy lifting
         if frame.dest == SRC_ADDRESS and frame.is_response:
-            # self.logger.info(str(frame))  # For debug purposes
+            # self.logger.debug(str(frame))  # For debug purposes
             self.log_to_output("response from: " + str(hex(frame.src)))
-            self.dict_present_cbs[frame.src].set(True)
+            if self.topology.mark_present(frame.src):
+                self.dict_present_cbs[frame.src].set(True)
             self.number_of_responses.set(self.number_of_responses.get() + 1)
             self.box_resp_rec.update()
         
@@ -495,9 +532,20 @@ class CUBEMELTER:
 
         self.log_to_output("Starting Scan")
 
+        if self.broker_client is not None:
+            self.number_of_addresses.set(len(self.topology.devices))
+            try:
+                self.ops.scan()
+            except Exception as e:
+                self.log_to_output("Exception: " + str(e))
+            # The results come back as a 'present' event
+            self.btn_scan["state"] = "normal"
+            return
+
         # Clear the GUI
         self.number_of_addresses.set(0)
         self.number_of_responses.set(0)
+        self.topology.clear_present()
         for value in self.dict_present_cbs.values():
             value.set(False)
 
@@ -514,10 +562,13 @@ class CUBEMELTER:
 
         # Scan all the possible DTL/DPM addresses
         # TODO: also scan and display devices that share a can address using the LUN (icecube pmms + supplies for ex.)
-        for device, address in AddressDictionary.items():
-            self.logger.info("Pinging: " + hex(address) + " " + device)
+        for device in self.topology.devices:
+            address = device.address
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug("Pinging: %s %s", hex(address), device.name,
+                                  extra=fields(address=address, channel=CNUM_CANT, command='HeartBeat'))
             try:
-                self.send_heartbeat(address)
+                self.ops.send_heartbeat(address)
             except CanTimeoutError:
                 # Nothing plugged in with usb2can
                 self.log_to_output("Error: Check the CAN bus")
@@ -543,58 +594,81 @@ class CUBEMELTER:
         self.log_to_output("Waiting for responses...")
         # At this point the listener should still be going for a bit, cleanup happens in self.stop_listener callback
 
+    def poll_broker_events(self, root):
+        """Applies the events the broker pushed since the last check, runs on the Tk thread"""
+        while True:
+            try:
+                event, data = self.broker_events.get_nowait()
+            except queue.Empty:
+                break
+            if event == 'present':
+                self.show_present(data)
+            elif event == 'snapshot':
+                self.show_snapshot(data)
+        root.after(BROKER_POLL_MS, self.poll_broker_events, root)
+
+    def show_present(self, addresses):
+        """Updates the checkboxes with the devices found present"""
+        self.topology.clear_present()
+        for value in self.dict_present_cbs.values():
+            value.set(False)
+        for address in addresses:
+            if self.topology.mark_present(address):
+                self.dict_present_cbs[address].set(True)
+        self.number_of_responses.set(len(addresses))
+
+    def show_snapshot(self, snapshot):
+        """Updates the environment boxes from a sweep snapshot"""
+        for address, env in snapshot['dpm'].items():
+            if env is not None:
+                self.dict_dpm_voltage[address].set(self.round_up(env['voltage'], 4))
+                self.dict_dpm_current[address].set(self.round_up(env['current'], 4))
+        for address, env in snapshot['dtl'].items():
+            if env is not None:
+                self.dict_dtl_temp[address].set(env['temp'])
+                self.dict_dtl_cpu_temp[address].set(env['cpu_temp'])
+        for supply_lun, rsp in snapshot['supply'].items():
+            if rsp is not None:
+                self.dict_supply_voltage[supply_lun].set(self.round_up(float(rsp['voltage']), 2))
+                self.dict_supply_current[supply_lun].set(float(rsp['current']))
+        self.total_dpm_power.set(self.get_total_dpm_power())
+        for anomaly in snapshot.get('anomalies', []):
+            self.log_to_output("Anomaly: " + describe(Anomaly(**anomaly)))
+
     def get_dpm_env(self, dpm_address):
+        """Reads a DPM into its boxes, returns {'voltage', 'current'} or None if it didn't answer"""
         self.log_to_output("Get DPM Env:" + str(hex(dpm_address)))
 
-        command = LCFCmd_GetEnvironment.build_command()
         try:
-            response_bytes = MsgSender.send_command_sync(channel_num=CNUM_CANT,
-                                                         src=SRC_ADDRESS,
-                                                         dest=dpm_address,
-                                                         command=command,
-                                                         timeout=2)
+            rsp = self.ops.read_dpm_env(dpm_address)
         except Exception as err:
             self.log_to_output("Failed to get environment:" + str(err))
-        rsp = LCFCmd_GetEnvironment.parse_response(response_bytes)
+            return None
         dpm_volts = f'{rsp["voltage"]}'
         dpm_current = f'{rsp["current"]}'
         self.dict_dpm_voltage[dpm_address].set((self.round_up(float(dpm_volts), 4)))
         self.dict_dpm_current[dpm_address].set((self.round_up(float(dpm_current), 4)))
+        return {'voltage': float(dpm_volts), 'current': float(dpm_current)}
 
     def get_dtl_env(self, dtl_address):
+        """Reads a DTL into its boxes, returns its temperature or None if it didn't answer"""
         self.log_to_output("Get DTL Env:" + str(hex(dtl_address)))
 
-        command = LCFCmd_GetEnvironment.build_command()
         try:
-            response_bytes = MsgSender.send_command_sync(channel_num=CNUM_CANT,
-                                                         src=SRC_ADDRESS,
-                                                         dest=dtl_address,
-                                                         command=command,
-                                                         timeout=2)
+            dtl_temp, dtl_cpu_temp = self.ops.read_dtl_env(dtl_address)
         except Exception as err:
             self.log_to_output("Failed to get environment:" + str(err))
-        # Parse response_bytes directly as dtl env is not part of spectracan
-        rsp_array = list(response_bytes)
-        dtl_temp = rsp_array[8]
-        dtl_cpu_temp = rsp_array[9]
+            return None
+        self.dict_dtl_temp[dtl_address].set(dtl_temp)
+        self.dict_dtl_cpu_temp[dtl_address].set(dtl_cpu_temp)
 
-        command = ArbitraryCommand.build_command(payload=[0x6f,0x35,0x01])
         try:
-        
-            response_bytes = MsgSender.send_command_sync(channel_num=CNUM_CANT,
-                                           src=SRC_ADDRESS,
-                                           dest=dtl_address,
-                                           command=command)
+            fets_enabled_five, fets_enabled_twelve = self.ops.read_dtl_fets(dtl_address)
         except Exception as err:
             self.log_to_output("Failed to get fets:" + str(err))
-
-        rsp_array = list(response_bytes)
-        fets_enabled_five = rsp_array[1]
-        fets_enabled_twelve = rsp_array[2]
-        self.dict_dtl_temp[dtl_address].set(dtl_temp)
-        self.dict_dtl_cpu_temp[dtl_address].set(dtl_cpu_temp)
-        self.dict_5v_fet_set[dtl_address].set(fets_enabled_five)
-        self.dict_12v_fet_set[dtl_address].set(fets_enabled_twelve)
+        else:
+            self.dict_5v_fet_set[dtl_address].set(fets_enabled_five)
+            self.dict_12v_fet_set[dtl_address].set(fets_enabled_twelve)
 
         # Adds Temperature Control for Fet Shut off
         if dtl_temp > DTL_MAX_TEMP:
@@ -603,41 +677,41 @@ class CUBEMELTER:
             output_string = ("Set DTL:" + str(hex(dtl_address)) + " {#5VFets:" +
                          str(fets_to_set_5) + ", #12VFets:" + str(fets_to_set_12) + "}")
             self.log_to_output(output_string)
-            command = ArbitraryCommand.build_command(payload=[0x6f, 0x35, 0x02, 0, 0])
-            MsgSender.send_command_no_response(channel_num=CNUM_CANT,
-                                           src=SRC_ADDRESS,
-                                           dest=dtl_address,
-                                           command=command)
-        
+            self.report_fet_batch(self.ops.set_fets_batch({dtl_address: (fets_to_set_5, fets_to_set_12)}))
+        return dtl_temp
+
     def get_dtl_env_cont(self):
-        dtl_addresses = [
-            0x08,0x09,0x0A,0x0B,0x0C,0x0D,0x0E,0x0F,
-            0x18,0x19,0x1A,0x1B,0x1C,0x1D,0x1E,0x1F,
-            0x28,0x29,0x2A,0x2B,0x2C,0x2D,0x2E,0x2F,
-            0x38,0x39,0x3A,0x3B,0x3C,0x3D,0x3E,0x3F
-            ]
-
-        for i in self.dict_present_cbs:
-            t_f = self.dict_present_cbs[i].get()
-            if t_f is True and i in dtl_addresses:
-                time.sleep(0.01)
-                self.get_dtl_env(i)
+        started = time.time()
+        readings = dict()
+        for i in self.topology.present(ROLE_DTL):
+            self.ops.pacing.pace(CNUM_CANT, KIND_DTL_ENV)
+            dtl_temp = self.get_dtl_env(i)
+            if dtl_temp is not None:
+                readings[i] = {'temp': dtl_temp}
+        self.check_anomalies(started, dtl=readings)
 
     def get_dpm_env_cont(self):
-        dpm_addresses = [
-            0x00,0x01,0x02,0x03,0x04,0x05,0x06,0x07,
-            0x10,0x11,0x12,0x13,0x14,0x15,0x16,0x17,
-            0x20,0x21,0x22,0x23,0x24,0x25,0x26,0x27,
-            0x30,0x31,0x32,0x33,0x34,0x35,0x36,0x37
-            ]
-
-        for i in self.dict_present_cbs:
-            t_f = self.dict_present_cbs[i].get()
-            if t_f is True and i in dpm_addresses:
-                time.sleep(0.02)
-                self.get_dpm_env(i)
+        started = time.time()
+        readings = dict()
+        for i in self.topology.present(ROLE_DPM):
+            self.ops.pacing.pace(CNUM_CANT, KIND_ENV)
+            reading = self.get_dpm_env(i)
+            if reading is not None:
+                readings[i] = reading
         # self.log_to_output("total power is: " + str(self.get_total_dpm_power()))
         self.total_dpm_power.set(self.get_total_dpm_power())
+        self.check_anomalies(started, dpm=readings)
+
+    def check_anomalies(self, sweep_time, dpm=None, dtl=None):
+        """Runs the anomaly detection on the readings of the sweep that just ran
+
+        Devices the sweep didn't read are left out, so the boxes of earlier sweeps or of
+        devices never read don't count as readings. The supplies aren't part of these
+        sweeps, so the power check only runs on broker snapshots.
+        """
+        snapshot = {'time': sweep_time, 'dpm': dpm or dict(), 'dtl': dtl or dict(), 'supply': dict()}
+        for anomaly in self.detector.check(snapshot):
+            self.log_to_output("Anomaly: " + describe(anomaly))
 
     def get_total_dpm_power(self):
         total_current = 0.0
@@ -646,44 +720,23 @@ class CUBEMELTER:
         return total_current * 12
 
     def disable_dpms(self):
-        dpm_addresses = [
-            0x00, 0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 0x07,
-            0x10, 0x11, 0x12, 0x13, 0x14, 0x15, 0x16, 0x17,
-            0x20, 0x21, 0x22, 0x23, 0x24, 0x25, 0x26, 0x27,
-            0x30, 0x31, 0x32, 0x33, 0x34, 0x35, 0x36, 0x37
-        ]
-        for i in self.dict_present_cbs:
-            t_f = self.dict_present_cbs[i].get()
-            if t_f is True and i in dpm_addresses:
-                time.sleep(0.01)
-                self.set_dpm_disable(i)
-    
+        for i in self.topology.present(ROLE_DPM):
+            self.ops.pacing.pace(CNUM_CANT, KIND_DPM_POWER)
+            self.set_dpm_disable(i)
+
     def enable_dpms(self):
-        dpm_addresses = [
-            0x00, 0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 0x07,
-            0x10, 0x11, 0x12, 0x13, 0x14, 0x15, 0x16, 0x17,
-            0x20, 0x21, 0x22, 0x23, 0x24, 0x25, 0x26, 0x27,
-            0x30, 0x31, 0x32, 0x33, 0x34, 0x35, 0x36, 0x37
-        ]
-        for i in self.dict_present_cbs:
-            t_f = self.dict_present_cbs[i].get()
-            if t_f is True and i in dpm_addresses:
-                time.sleep(0.01)
-                self.set_dpm_enable(i)
+        for i in self.topology.present(ROLE_DPM):
+            self.ops.pacing.pace(CNUM_CANT, KIND_DPM_POWER)
+            self.set_dpm_enable(i)
 
     def get_supply_env(self, supply_lun):
         self.log_to_output("Get Supply Env, LUN: " + str(hex(supply_lun)))
 
-        command = LCFCmd_GetEnvironment.build_command(lun=supply_lun)
         try:
-            response_bytes = MsgSender.send_command_sync(channel_num=CNUM_CANR,
-                                                         src=SRC_ADDRESS,
-                                                         dest=PMM_ADDRESS,
-                                                         command=command,
-                                                         timeout=2)
+            rsp = self.ops.read_supply_env(supply_lun)
         except Exception as err:
             self.log_to_output("Failed to get environment:" + str(err))
-        rsp = LCFCmd_GetEnvironment.parse_response(response_bytes)
+            return
         self.log_to_output("Response is :" + str(rsp))
         supply_volts = f'{rsp["voltage"]}'
         supply_current = f'{rsp["current"]}'
@@ -693,21 +746,11 @@ class CUBEMELTER:
 
     def set_dpm_enable(self, dpm_address):
         self.log_to_output("Enable DPM:" + str(hex(dpm_address)))
-
-        command = PMM_DeviceEnableCmd.build_command(sub_module=0x00)
-        MsgSender.send_command_no_response(channel_num=CNUM_CANT,
-                                           src=SRC_ADDRESS,
-                                           dest=dpm_address,
-                                           command=command)
+        self.ops.enable_dpm(dpm_address)
 
     def set_dpm_disable(self, dpm_address):
         self.log_to_output("Disable DPM:" + str(hex(dpm_address)))
-
-        command = PMM_DeviceDisableCmd.build_command(sub_module=0x00)
-        MsgSender.send_command_no_response(channel_num=CNUM_CANT,
-                                           src=SRC_ADDRESS,
-                                           dest=dpm_address,
-                                           command=command)
+        self.ops.disable_dpm(dpm_address)
 
     def set_dtl_load(self, dtl_address):
         fets_to_set_5 = self.dict_5v_fet_set[dtl_address].get()
@@ -716,45 +759,56 @@ class CUBEMELTER:
                          str(fets_to_set_5) + ", #12VFets:" + str(fets_to_set_12) + "}")
 
         self.log_to_output(output_string)
-
-        command = ArbitraryCommand.build_command(payload=[0x6f, 0x35, 0x02, fets_to_set_5, fets_to_set_12])
-        MsgSender.send_command_no_response(channel_num=CNUM_CANT,
-                                           src=SRC_ADDRESS,
-                                           dest=dtl_address,
-                                           command=command)
-
-    # TODO: use optional paramters instead of 2 separate functions
-    def set_dtl_load_spec(self, dtl_address, fets_5, fets_12):
-        fets_to_set_5 = fets_5
-        fets_to_set_12 = fets_12
-        output_string = ("Set DTL:" + str(hex(dtl_address)) + " {#5VFets:" +
-                         str(fets_to_set_5) + ", #12VFets:" + str(fets_to_set_12) + "}")
-
-        self.log_to_output(output_string)
-
-        command = ArbitraryCommand.build_command(payload=[0x6f, 0x35, 0x02, fets_to_set_5, fets_to_set_12])
-        MsgSender.send_command_no_response(channel_num=CNUM_CANT,
-                                           src=SRC_ADDRESS,
-                                           dest=dtl_address,
-                                           command=command)
+        self.report_fet_batch(self.ops.set_fets_batch({dtl_address: (fets_to_set_5, fets_to_set_12)}))
 
     def set_all_fets(self):
         self.log_to_output("Setting all 5V Fets to:" + str(self.all_fets_five.get())
                            + ", 12V Fets to:" + str(self.all_fets_twelve.get()))
 
-        # TODO: these are used multiple places, use broader scope
-        dtl_addresses = [
-            0x08, 0x09, 0x0A, 0x0B, 0x0C, 0x0D, 0x0E, 0x0F,
-            0x18, 0x19, 0x1A, 0x1B, 0x1C, 0x1D, 0x1E, 0x1F,
-            0x28, 0x29, 0x2A, 0x2B, 0x2C, 0x2D, 0x2E, 0x2F,
-            0x38, 0x39, 0x3A, 0x3B, 0x3C, 0x3D, 0x3E, 0x3F
-        ]
+        fets = (self.all_fets_five.get(), self.all_fets_twelve.get())
+        targets = {i: fets for i in self.topology.present(ROLE_DTL)}
+        self.report_fet_batch(self.ops.set_fets_batch(targets))
+
+    def go_to_power_target(self):
+        """Sets the DTL fets so the total DPM power reaches the target"""
+        target = self.target_power.get()
+        supply_limit = self.supply_limit.get() or None
+        self.log_to_output("Going to " + str(target) + "W" +
+                           ("" if supply_limit is None else ", max " + str(supply_limit) + "W per supply"))
 
-        for i in self.dict_present_cbs:
-            t_f = self.dict_present_cbs[i].get()
-            if t_f is True and i in dtl_addresses:
-                time.sleep(0.01)
-                self.set_dtl_load_spec(i, self.all_fets_five.get(), self.all_fets_twelve.get())
+        def show_step(step):
+            self.log_to_output("Step " + str(step.iteration) + ": " + str(round(step.measured, 1)) +
+                               "W of " + str(round(step.goal, 1)) + "W")
+            for address, (fets_5, fets_12) in step.allocation.items():
+                self.dict_5v_fet_set[address].set(fets_5)
+                self.dict_12v_fet_set[address].set(fets_12)
+
+        try:
+            result = PowerController(self.ops, self.topology).run(target, supply_limit, progress=show_step)
+        except Exception as err:
+            self.log_to_output("Power target failed: " + str(err))
+            return
+        if result.status == REACHED:
+            outcome = "Reached "
+        elif result.status == LIMITED_BY_SUPPLY:
+            outcome = "Limited by supply, " + str(target) + "W target not reached, at "
+        else:
+            outcome = "Stopped at "
+        self.log_to_output(outcome + str(round(result.measured, 1)) + "W after " +
+                           str(len(result.history)) + " steps")
+
+    def report_fet_batch(self, report):
+        """Shows the result of a verified fet set in the output window"""
+        for address, result in report.items():
+            if result.applied is not None:
+                self.dict_5v_fet_set[address].set(result.applied[0])
+                self.dict_12v_fet_set[address].set(result.applied[1])
+            if result.status != FET_APPLIED:
+                self.log_to_output("DTL:" + str(hex(address)) + " " + result.status + " after " +
+                                   str(result.attempts) + " tries, wanted " + str(result.requested) +
+                                   " got " + str(result.applied))
+        applied = sum(1 for result in report.values() if result.status == FET_APPLIED)
+        self.log_to_output("Fets applied on " + str(applied) + "/" + str(len(report)) + " DTLs")
 
     def log_to_output(self, info):
         """Add info to the log AND to the output window"""
@@ -770,12 +824,6 @@ class CUBEMELTER:
         return math.ceil(n * multiplier) / multiplier
 
 
-class ArbitraryCommand(CanCommand):
-    @classmethod
-    def build_command(cls, *, payload, ack=False):
-        return cls._start_command(payload[0], ack) + payload[1:]
-
-
 def resource_path(relative_path):
     """Get absolute path to resource, works for dev and for PyInstaller"""
     try:
@@ -789,28 +837,42 @@ def resource_path(relative_path):
 
 def main():
     """Start the CUBEMELTER tool"""
-    logging.basicConfig(
-        format='[%(asctime)s] %(levelname)s : %(name)s %(funcName)s() - %(message)s',
-        level=logging.INFO,
-        handlers=[
-            RotatingFileHandler(LOG_NAME, maxBytes=1000000, backupCount=5),  # ~1MB
-            logging.StreamHandler()
-        ]
-    )
+    parser = argparse.ArgumentParser(description='CUBEMELTER ' + VERSION)
+    parser.add_argument('--topology', default=resource_path(TOPOLOGY_FILE),
+                        help='json file describing the cubes, DBAs and supplies (default: %(default)s)')
+    parser.add_argument('--pacing', default=PACING_PATH,
+                        help='calibrated pacing profile, the defaults are used if it is missing (default: %(default)s)')
+    parser.add_argument('--broker', nargs='?', const='{}:{}'.format(BROKER_HOST, BROKER_PORT), metavar='HOST:PORT',
+                        help='use a running broker (python broker.py serve) instead of opening the CAN channels')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    parser.add_argument('--log-format', default='text', choices=LOG_FORMATS,
+                        help='format of ' + LOG_NAME + ', json writes one json object per line')
+    args = parser.parse_args()
+
+    log_listener = setup_logging(LOG_NAME, args.log_level, args.log_format)
     logger = logging.getLogger(__name__)
 
     logger.info('Starting the CUBEMELTER tool')
+    broker_client = None
     # Run the program
     try:
+        topology = Topology.load(args.topology)
+        if args.broker:
+            host, _, port = args.broker.rpartition(':')
+            broker_client = BrokerClient(host or BROKER_HOST, int(port))
         root = Tk()
-        CUBEMELTER(root)
+        CUBEMELTER(root, topology, broker_client, PacingProfile.load(args.pacing))
         root.mainloop()
     except Exception as err:  # pylint: disable=broad-except
         logger.exception(err)
     finally:
         logger.info('Closing the program')
-        logger.info('Shutting down Channel(s)')
-        ChannelManager.shutdown_channels()
+        if broker_client is not None:
+            broker_client.close()
+        else:
+            logger.info('Shutting down Channel(s)')
+            ChannelManager.shutdown_channels()
+        log_listener.stop()
         logging.shutdown()
 
 
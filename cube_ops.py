@@ -0,0 +1,409 @@
+##
+# Module with the bus level operations used by the CUBEMELTER Tool
+
+import logging
+import threading
+import time
+from collections import namedtuple
+from functools import partial
+
+from spectracan import ChannelManager, MsgSender
+from spectracan.can_commands import (LCFCmd_HeartBeat, PMM_DeviceEnableCmd, PMM_DeviceDisableCmd,
+                                     LCFCmd_GetEnvironment, CanCommand)
+from spectracan.can_enums import LcfAddress
+from spectracan.error import CanTimeoutError
+from spectracan.spectra_listener import SpectraListener
+
+from env_cache import EnvCache
+from log_pipeline import fields
+from pacing import PacingProfile, KIND_ENV, KIND_DTL_ENV, KIND_FETS, KIND_FET_SET
+
+CNUM_CANR = 0
+CNUM_CANT = 1
+
+# {channel_num : (name, bit rate)}
+CHANNELS = {CNUM_CANR: ('CANR', 400_000),
+            CNUM_CANT: ('CANT', 800_000)}
+
+SRC_ADDRESS = LcfAddress.CAN_OPENER.value
+PMM_ADDRESS = LcfAddress.PCM_PMM_MAIN.value
+
+# DTL fet load commands, sent as ArbitraryCommands
+DTL_FET_PAYLOAD = [0x6f, 0x35]
+DTL_FET_GET = 0x01
+DTL_FET_SET = 0x02
+
+# Command names used in the read cache keys
+CMD_GET_ENV = 'GetEnvironment'
+CMD_GET_FETS = 'GetFets'
+
+# Timeout in seconds for single, user initiated requests
+REQUEST_TIMEOUT = 2
+
+# Time in seconds to wait for heartbeat responses during the scan
+LISTENING_TIME = 3
+
+# Timeout in seconds for each read of a sweep
+SWEEP_TIMEOUT = 0.5
+
+# How long to wait for each readback of a batch
+READBACK_TIMEOUT = 0.1
+# Number of times a batch re-sends to DTLs that did not apply their counts
+BATCH_RETRIES = 2
+
+# DTL temperature above which its fets are shut off
+DTL_MAX_TEMP = 90
+
+# Outcome of a verified fet set for one DTL
+FET_APPLIED = 'applied'
+FET_MISMATCHED = 'mismatched'
+FET_MISSING = 'missing'
+
+FetResult = namedtuple('FetResult', ['status', 'requested', 'applied', 'attempts'])
+
+# Environment and fet state of a DTL, with the epoch times each half was received
+# The fet fields and fets_time are None if only the environment answered
+DtlReadback = namedtuple('DtlReadback', ['temp', 'cpu_temp', 'fets_5', 'fets_12', 'env_time', 'fets_time'])
+
+
+# {channel_num : Lock held around each send_command_sync on the channel}
+_channel_locks = dict()
+_channel_locks_lock = threading.Lock()
+
+
+def channel_lock(channel_num):
+    """Lock that serializes the sync requests on a channel
+
+    Nothing shows MsgSender.send_command_sync is safe to call from several threads at once,
+    and the broker, the GUI and AsyncTransport all request from several threads, so every
+    sync request on a channel holds its lock.
+    """
+    with _channel_locks_lock:
+        return _channel_locks.setdefault(channel_num, threading.Lock())
+
+
+class ArbitraryCommand(CanCommand):
+    @classmethod
+    def build_command(cls, *, payload, ack=False):
+        return cls._start_command(payload[0], ack) + payload[1:]
+
+
+def parse_dtl_env(response_bytes):
+    """(temp, cpu_temp) from a DTL's GetEnvironment response
+
+    Raises:
+        ValueError if the response is too short to hold them
+    """
+    # Parse response_bytes directly as dtl env is not part of spectracan
+    rsp_array = list(response_bytes)
+    if len(rsp_array) < 10:
+        raise ValueError('DTL environment response too short: {}'.format(bytes(rsp_array).hex()))
+    return rsp_array[8], rsp_array[9]
+
+
+def parse_dtl_fets(response_bytes):
+    """(5V fets, 12V fets) from a DTL's fet read response
+
+    Raises:
+        ValueError if the response is too short to hold them
+    """
+    rsp_array = list(response_bytes)
+    if len(rsp_array) < 3:
+        raise ValueError('DTL fet response too short: {}'.format(bytes(rsp_array).hex()))
+    return rsp_array[1], rsp_array[2]
+
+
+def setup_channel(channel_num, device_type='kvaser'):
+    """Sets up a channel with its bit rate from CHANNELS"""
+    ChannelManager.setup_channel(channel_num=channel_num, device_type=device_type,
+                                 bit_rate=CHANNELS[channel_num][1])
+
+
+class CubeOps:
+    """Operations on the cube's DPMs, DTLs and supplies, independent of the GUI"""
+
+    def __init__(self, channel_r=CNUM_CANR, channel_t=CNUM_CANT, src=SRC_ADDRESS, pacing=None):
+        """Initializes a CubeOps object
+
+        Args:
+            channel_r: Channel number the PMM and supplies are on
+            channel_t: Channel number the DPMs and DTLs are on
+            src: Address the commands are sent from
+            pacing: PacingProfile for the bulk operations, defaults to the calibrated one if there is one
+        """
+        self.logger = logging.getLogger(__name__)
+        self.channel_r = channel_r
+        self.channel_t = channel_t
+        self.src = src
+        self.pacing = pacing or PacingProfile.load()
+        self.cache = EnvCache()
+
+    def close(self):
+        """Nothing to release, kept so CubeOps and RemoteCubeOps can be used the same way"""
+
+    def _send(self, dest, command, channel_num=None):
+        MsgSender.send_command_no_response(channel_num=self.channel_t if channel_num is None else channel_num,
+                                           src=self.src,
+                                           dest=dest,
+                                           command=command)
+
+    def _request(self, dest, command, timeout=REQUEST_TIMEOUT, channel_num=None):
+        channel_num = self.channel_t if channel_num is None else channel_num
+        with channel_lock(channel_num):
+            started = time.monotonic()
+            response_bytes = MsgSender.send_command_sync(channel_num=channel_num,
+                                                         src=self.src,
+                                                         dest=dest,
+                                                         command=command,
+                                                         timeout=timeout)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('Response from %s', hex(dest),
+                              extra=fields(address=dest, channel=channel_num, command=bytes(command).hex(),
+                                           latency=round(time.monotonic() - started, 6)))
+        return response_bytes
+
+    def send_heartbeat(self, address):
+        self._send(address, LCFCmd_HeartBeat.build_command())
+
+    def enable_dpm(self, dpm_address):
+        self._send(dpm_address, PMM_DeviceEnableCmd.build_command(sub_module=0x00))
+
+    def disable_dpm(self, dpm_address):
+        self._send(dpm_address, PMM_DeviceDisableCmd.build_command(sub_module=0x00))
+
+    def _cached_request(self, dest, command, command_name, timeout, max_age, channel_num=None, lun=None):
+        """_request through the read cache, see EnvCache.read for max_age"""
+        channel_num = self.channel_t if channel_num is None else channel_num
+        return self.cache.read((channel_num, dest, lun, command_name),
+                               lambda: self._request(dest, command, timeout, channel_num),
+                               max_age, timeout)
+
+    def read_dpm_env(self, dpm_address, timeout=REQUEST_TIMEOUT, max_age=0.0):
+        """Returns the parsed GetEnvironment response of a DPM"""
+        response_bytes = self._cached_request(dpm_address, LCFCmd_GetEnvironment.build_command(),
+                                              CMD_GET_ENV, timeout, max_age)
+        return LCFCmd_GetEnvironment.parse_response(response_bytes)
+
+    def read_dtl_env(self, dtl_address, timeout=REQUEST_TIMEOUT, max_age=0.0):
+        """Returns (temp, cpu_temp) of a DTL"""
+        response_bytes = self._cached_request(dtl_address, LCFCmd_GetEnvironment.build_command(),
+                                              CMD_GET_ENV, timeout, max_age)
+        return parse_dtl_env(response_bytes)
+
+    def read_dtl_fets(self, dtl_address, timeout=REQUEST_TIMEOUT, max_age=0.0):
+        """Returns (5V fets, 12V fets) currently enabled on a DTL"""
+        command = ArbitraryCommand.build_command(payload=DTL_FET_PAYLOAD + [DTL_FET_GET])
+        return parse_dtl_fets(self._cached_request(dtl_address, command, CMD_GET_FETS, timeout, max_age))
+
+    def request_many(self, requests, timeout, kind, max_age=0.0):
+        """Requests to the DPM/DTL channel, sent one after another and paced by the gap for their kind
+
+        Each is a send_command_sync of its own, so every response is the one MsgSender
+        reassembled for its request. They go through the read cache like single reads: a
+        request already in flight from another caller is waited on instead of sent again, and
+        readings up to max_age seconds old come from the cache.
+
+        Args:
+            requests: [(address, built command, command name for the cache)]
+            timeout: Seconds to wait for each response
+            kind: Pacing kind of the requests
+
+        Returns:
+            {(address, command name) : (response bytes, epoch time received) or None if it didn't answer}
+        """
+        results = dict()
+        gap = self.pacing.gap(self.channel_t, kind)
+        sent = list()
+
+        def fetch(address, command):
+            if sent and gap:
+                time.sleep(gap)
+            sent.append(address)
+            return self._request(address, command, timeout)
+
+        for address, command, command_name in requests:
+            try:
+                results[(address, command_name)] = self.cache.read_timed(
+                    (self.channel_t, address, None, command_name), partial(fetch, address, command), max_age, timeout)
+            except Exception as err:  # pylint: disable=broad-except
+                self.logger.debug('No response from %s to %s: %s', hex(address), command_name, err)
+                results[(address, command_name)] = None
+        return results
+
+    def _parsed(self, responses, address, command_name, parse):
+        """parse(response bytes) of a request_many result, None if it didn't answer or the response is bad"""
+        response = responses[(address, command_name)]
+        if response is None:
+            return None
+        try:
+            return parse(response[0])
+        except Exception as err:  # pylint: disable=broad-except
+            self.logger.warning('Bad %s response from %s: %s', command_name, hex(address), err)
+            return None
+
+    def read_dtl(self, dtl_address, timeout=REQUEST_TIMEOUT, max_age=0.0):
+        """Reads the environment and fet state of a DTL
+
+        Returns:
+            DtlReadback, with the fet fields None if only the fet request failed
+
+        Raises:
+            CanTimeoutError if the environment request wasn't answered
+        """
+        readback = self.read_dtl_many([dtl_address], timeout, max_age)[dtl_address]
+        if readback is None:
+            raise CanTimeoutError('No environment response from {}'.format(hex(dtl_address)))
+        return readback
+
+    def read_dtl_many(self, dtl_addresses, timeout=REQUEST_TIMEOUT, max_age=0.0):
+        """read_dtl of several DTLs
+
+        Returns:
+            {address : DtlReadback or None if its environment didn't answer or was malformed}
+        """
+        env_command = LCFCmd_GetEnvironment.build_command()
+        fets_command = ArbitraryCommand.build_command(payload=DTL_FET_PAYLOAD + [DTL_FET_GET])
+        requests = list()
+        for address in dtl_addresses:
+            requests += [(address, env_command, CMD_GET_ENV), (address, fets_command, CMD_GET_FETS)]
+        responses = self.request_many(requests, timeout, KIND_DTL_ENV, max_age)
+
+        readbacks = dict()
+        for address in dtl_addresses:
+            env = self._parsed(responses, address, CMD_GET_ENV, parse_dtl_env)
+            if env is None:
+                readbacks[address] = None
+                continue
+            fets = self._parsed(responses, address, CMD_GET_FETS, parse_dtl_fets)
+            fets_5, fets_12 = (None, None) if fets is None else fets
+            readbacks[address] = DtlReadback(*env, fets_5, fets_12, responses[(address, CMD_GET_ENV)][1],
+                                             None if fets is None else responses[(address, CMD_GET_FETS)][1])
+        return readbacks
+
+    def set_dtl_fets(self, dtl_address, fets_5, fets_12):
+        """Sets the fet counts of a DTL without waiting for any confirmation"""
+        command = ArbitraryCommand.build_command(payload=DTL_FET_PAYLOAD + [DTL_FET_SET, fets_5, fets_12])
+        self.cache.invalidate((self.channel_t, dtl_address, None, CMD_GET_FETS))
+        self._send(dtl_address, command)
+
+    def read_supply_env(self, supply_lun, timeout=REQUEST_TIMEOUT, max_age=0.0):
+        """Returns the parsed GetEnvironment response of a supply behind the PMM"""
+        command = LCFCmd_GetEnvironment.build_command(lun=supply_lun)
+        response_bytes = self._cached_request(PMM_ADDRESS, command, CMD_GET_ENV, timeout, max_age,
+                                              channel_num=self.channel_r, lun=supply_lun)
+        return LCFCmd_GetEnvironment.parse_response(response_bytes)
+
+    def read_dpm_env_many(self, dpm_addresses, timeout=REQUEST_TIMEOUT, max_age=0.0):
+        """read_dpm_env of several DPMs, {address: parsed response or None if it didn't answer or was malformed}"""
+        command = LCFCmd_GetEnvironment.build_command()
+        responses = self.request_many([(address, command, CMD_GET_ENV) for address in dpm_addresses],
+                                      timeout, KIND_ENV, max_age)
+        return {address: self._parsed(responses, address, CMD_GET_ENV, LCFCmd_GetEnvironment.parse_response)
+                for address in dpm_addresses}
+
+    def read_dtl_fets_many(self, dtl_addresses, timeout=READBACK_TIMEOUT):
+        """Fet readback of several DTLs, {address: (5V fets, 12V fets) or None}
+
+        Always read from the DTLs, never the cache, since this verifies fet sets.
+        """
+        command = ArbitraryCommand.build_command(payload=DTL_FET_PAYLOAD + [DTL_FET_GET])
+        responses = self.request_many([(address, command, CMD_GET_FETS) for address in dtl_addresses],
+                                      timeout, KIND_FETS)
+        return {address: self._parsed(responses, address, CMD_GET_FETS, parse_dtl_fets)
+                for address in dtl_addresses}
+
+    def scan(self, addresses, listening_time=LISTENING_TIME):
+        """Sends a heartbeat to every address and returns the set of addresses that answered"""
+        responders = set()
+        finished = threading.Event()
+
+        def frame_handler(frame):
+            if frame.dest == self.src and frame.is_response:
+                responders.add(frame.src)
+
+        listener = SpectraListener(self.channel_t)
+        listener.start_frame_consumer(frame_callback=frame_handler,
+                                      timeout=listening_time,
+                                      timeout_callback=finished.set)
+        listener.start_timer.set()
+        try:
+            for address in addresses:
+                self.send_heartbeat(address)
+            finished.wait(listening_time + 1)
+        finally:
+            listener.stop = True
+        return responders
+
+    def sweep(self, dpm_addresses=(), dtl_addresses=(), supply_luns=(), timeout=SWEEP_TIMEOUT, max_age=0.0):
+        """Reads the environment of every given device, readings up to max_age seconds old may come from the cache
+
+        Returns a snapshot dict:
+            {'time': epoch seconds,
+             'dpm': {address: {'voltage', 'current'} or None},
+             'dtl': {address: DtlReadback fields as a dict or None},
+             'supply': {lun: parsed GetEnvironment response or None}}
+        """
+        snapshot = {'time': time.time()}
+        dpm_envs = self.read_dpm_env_many(dpm_addresses, timeout, max_age)
+        snapshot['dpm'] = {address: None if rsp is None else
+                           {'voltage': float(rsp['voltage']), 'current': float(rsp['current'])}
+                           for address, rsp in dpm_envs.items()}
+
+        snapshot['dtl'] = {address: None if readback is None else readback._asdict()
+                           for address, readback in self.read_dtl_many(dtl_addresses, timeout, max_age).items()}
+
+        # The supplies all sit behind the PMM address, so read them one at a time
+        snapshot['supply'] = dict()
+        for supply_lun in supply_luns:
+            try:
+                snapshot['supply'][supply_lun] = self.read_supply_env(supply_lun, timeout, max_age)
+            except Exception as err:  # pylint: disable=broad-except
+                self.logger.debug('No response from supply LUN %s: %s', supply_lun, err)
+                snapshot['supply'][supply_lun] = None
+            self.pacing.pace(self.channel_r, KIND_ENV)
+        return snapshot
+
+    def set_fets_batch(self, targets, retries=BATCH_RETRIES, send_gap=None,
+                       readback_timeout=READBACK_TIMEOUT):
+        """Sets the fet counts of many DTLs and verifies they were applied
+
+        The set frames go out back-to-back, then every target is read back.
+        Only the DTLs that failed to apply their counts are sent to again.
+
+        Args:
+            targets: {int dtl_address : (fets_5, fets_12)}
+            retries: Number of extra attempts for DTLs that failed
+            send_gap: Seconds to wait between set frames, defaults to the fet set pacing
+            readback_timeout: Seconds to wait for each readback
+
+        Returns:
+            {int dtl_address : FetResult}
+        """
+        if send_gap is None:
+            send_gap = self.pacing.gap(self.channel_t, KIND_FET_SET)
+        report = dict()
+        pending = dict(targets)
+        for attempt in range(1, retries + 2):
+            for address, (fets_5, fets_12) in pending.items():
+                self.set_dtl_fets(address, fets_5, fets_12)
+                if send_gap:
+                    time.sleep(send_gap)
+
+            readback = self.read_dtl_fets_many(pending, readback_timeout)
+            failed = dict()
+            for address, requested in pending.items():
+                applied = readback[address]
+                if applied is None:
+                    status = FET_MISSING
+                elif tuple(applied) == tuple(requested):
+                    status = FET_APPLIED
+                else:
+                    status = FET_MISMATCHED
+                report[address] = FetResult(status, tuple(requested), applied, attempt)
+                if status != FET_APPLIED:
+                    failed[address] = requested
+
+            pending = failed
+            if not pending:
+                break
+        return report
@@ -0,0 +1,94 @@
+##
+# Module with the read-through cache for device reads used by the CUBEMELTER Tool
+#
+# Reads are keyed by (channel, address, LUN, command). A read for a key that is already on
+# the bus waits for that transaction instead of sending another one, and a caller that can
+# live with a reading up to max_age seconds old is served from the cache.
+
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+
+class EnvCache:
+    """Coalescing, TTL'd cache of device reads"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = dict()      # {key : (monotonic time of the reading, epoch time of the reading, value)}
+        self._in_flight = dict()    # {key : Future}
+        self.stats = {'requests': 0, 'hits': 0, 'coalesced': 0, 'misses': 0, 'errors': 0}
+
+    def read(self, key, fetch, max_age=0.0, timeout=None):
+        """Returns the value for key
+
+        Args:
+            key: (channel, address, lun, command)
+            fetch: Called with no arguments to read the value from the bus
+            max_age: Seconds old a cached value may be, 0 only shares a read already in flight
+            timeout: Seconds to wait on a read already in flight, the caller's own request
+                timeout, so joining a slower caller's read doesn't stretch it
+
+        Raises:
+            Whatever fetch raised, for every caller that was waiting on it
+            TimeoutError if the read in flight didn't finish within timeout
+        """
+        return self.read_timed(key, fetch, max_age, timeout)[0]
+
+    def read_timed(self, key, fetch, max_age=0.0, timeout=None):
+        """Like read, but returns (value, epoch time it was read)"""
+        now = time.monotonic()
+        with self._lock:
+            self.stats['requests'] += 1
+            entry = self._entries.get(key)
+            if entry is not None and max_age > 0 and now - entry[0] <= max_age:
+                self.stats['hits'] += 1
+                return entry[2], entry[1]
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._in_flight[key] = future
+                self.stats['misses'] += 1
+            else:
+                self.stats['coalesced'] += 1
+
+        if not owner:
+            try:
+                return future.result(timeout)
+            except FutureTimeoutError:
+                with self._lock:
+                    self.stats['errors'] += 1
+                raise TimeoutError('No response for {} within {}s'.format(key, timeout)) from None
+
+        try:
+            value = fetch()
+        except Exception as err:
+            with self._lock:
+                if self._in_flight.get(key) is future:
+                    del self._in_flight[key]
+                self.stats['errors'] += 1
+            future.set_exception(err)
+            raise
+        read_time = time.time()
+        with self._lock:
+            # Only store it if nobody invalidated the key while it was on the bus
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+                self._entries[key] = (time.monotonic(), read_time, value)
+        future.set_result((value, read_time))
+        return value, read_time
+
+    def invalidate(self, key):
+        """Forgets a key, reads already in flight won't be shared with later callers"""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._in_flight.pop(key, None)
+
+    def snapshot_stats(self):
+        """Copy of the counters, with the fraction of requests that didn't go on the bus"""
+        with self._lock:
+            stats = dict(self.stats)
+        saved = stats['hits'] + stats['coalesced']
+        stats['saved_fraction'] = saved / stats['requests'] if stats['requests'] else 0.0
+        return stats
@@ -0,0 +1,144 @@
+##
+# Module with the CUBEMELTER logging pipeline
+#
+# Log calls only put the record on a queue, the formatting and file/console I/O happen on a
+# background thread so verbose logging doesn't change the timing of the CAN operations.
+# Structured fields go in `extra`:
+#
+#   logger.debug('Response from %s', hex(address),
+#                extra=fields(address=address, channel=channel_num, command='GetEnvironment', latency=0.004))
+
+import json
+import logging
+import queue
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+LOG_FORMAT = '[%(asctime)s] %(levelname)s : %(name)s %(funcName)s() - %(message)s'
+LOG_FORMATS = ('text', 'json')
+
+# Records waiting to be written before new ones are dropped
+LOG_QUEUE_SIZE = 10000
+
+# Most often, in seconds, the writer logs how many records were dropped
+DROP_REPORT_INTERVAL = 60.0
+
+
+def fields(**kwargs):
+    """Builds the `extra` argument for a log call with structured fields"""
+    return {'fields': kwargs}
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Puts records on the queue without formatting them, drops records if the writer falls behind"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Formatting is left to the writer thread, the queue never leaves the process
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class DropReportingListener(QueueListener):
+    """QueueListener that writes a warning with the number of records the handler dropped
+
+    The warning goes straight to the handlers, the queue may be what is full. It is written
+    at most every DROP_REPORT_INTERVAL seconds while records are being dropped, and once
+    more when the listener stops.
+    """
+
+    def __init__(self, log_queue, queue_handler, *handlers, **kwargs):
+        super().__init__(log_queue, *handlers, **kwargs)
+        self.queue_handler = queue_handler
+        self.reported = 0
+        self._last_report = time.monotonic()
+
+    def report_dropped(self):
+        dropped = self.queue_handler.dropped
+        if dropped == self.reported:
+            return
+        record = logging.makeLogRecord({
+            'name': __name__, 'levelno': logging.WARNING, 'levelname': 'WARNING', 'funcName': 'report_dropped',
+            'msg': 'Dropped %d log records, %d since the last report',
+            'args': (dropped, dropped - self.reported),
+            'fields': {'dropped': dropped}})
+        self.reported = dropped
+        self._last_report = time.monotonic()
+        super().handle(record)
+
+    def handle(self, record):
+        if time.monotonic() - self._last_report >= DROP_REPORT_INTERVAL:
+            self.report_dropped()
+        super().handle(record)
+
+    def stop(self):
+        super().stop()
+        self.report_dropped()
+
+
+class TextFormatter(logging.Formatter):
+    """The usual log line, followed by the structured fields as key=value"""
+
+    def format(self, record):
+        line = super().format(record)
+        record_fields = getattr(record, 'fields', None)
+        if record_fields:
+            line += ' {' + ', '.join('{}={}'.format(key, value) for key, value in record_fields.items()) + '}'
+        return line
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """One json object per record, with the structured fields as top level keys"""
+
+    def format(self, record):
+        entry = {'time': record.created,
+                 'level': record.levelname,
+                 'name': record.name,
+                 'func': record.funcName,
+                 'msg': record.getMessage()}
+        entry.update(getattr(record, 'fields', None) or dict())
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def setup_logging(log_file, level=logging.INFO, log_format='text', console=True):
+    """Routes all logging through a queue to a background writer
+
+    Args:
+        log_file: Rotating file to write to
+        level: Records below this level are skipped before anything is formatted
+        log_format: 'text' or 'json' (json lines) for the log file, the console is always text
+        console: Also write to stderr
+
+    Returns:
+        The started QueueListener, stop it before exiting to flush the queue
+    """
+    file_handler = RotatingFileHandler(log_file, maxBytes=1000000, backupCount=5)  # ~1MB
+    file_handler.setFormatter(JsonLinesFormatter() if log_format == 'json' else TextFormatter(LOG_FORMAT))
+    handlers = [file_handler]
+    if console:
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(TextFormatter(LOG_FORMAT))
+        handlers.append(console_handler)
+
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    queue_handler = DroppingQueueHandler(log_queue)
+    listener = DropReportingListener(log_queue, queue_handler, *handlers, respect_handler_level=True)
+
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(queue_handler)
+    root_logger.setLevel(level)
+
+    listener.start()
+    return listener
@@ -0,0 +1,287 @@
+##
+# Module with the command pacing used by the CUBEMELTER Tool
+#
+# Bulk operations wait a per-channel, per-command-kind gap between commands. The gaps come
+# from pacing.json, written by the calibration below, or fall back to DEFAULT_GAPS.
+#
+# Calibration pushes bursts of commands at shrinking gaps and stops at the first gap where
+# responses go missing, fets don't apply or latency jumps; the safe gap is the last good
+# one times SAFETY_FACTOR. The bursts go through the same CubeOps bulk reads the gaps are
+# used by (read_dpm_env_many, read_dtl_many, read_dtl_fets_many). The fet set probe writes back each DTL's current counts, so
+# calibrating doesn't change the load.
+#
+# Usage:
+#   python pacing.py calibrate [--topology FILE] [--output FILE] [--device-type kvaser]
+#   python pacing.py show [--output FILE]
+#
+# The GUI, broker and soak runner take the profile from --pacing, by default pacing.json next
+# to the scripts.
+
+import argparse
+import json
+import logging
+import math
+import os
+import time
+from collections import namedtuple
+from datetime import datetime
+
+PACING_FILE = 'pacing.json'
+# Where the profile is looked for by default, next to the scripts like topology.json
+PACING_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), PACING_FILE)
+
+# Command kinds
+KIND_ENV = 'env'                # GetEnvironment requests to DPMs and supplies
+KIND_DTL_ENV = 'dtl_env'        # GetEnvironment (and fet readback) requests to DTLs
+KIND_FETS = 'fets'              # DTL fet readback requests
+KIND_FET_SET = 'fet_set'        # DTL fet set frames, no response
+KIND_DPM_POWER = 'dpm_power'    # DPM enable/disable, no response
+KINDS = (KIND_ENV, KIND_DTL_ENV, KIND_FETS, KIND_FET_SET, KIND_DPM_POWER)
+
+# Seconds between commands when there's no calibrated profile. These were the hand tuned sleeps,
+# except the fet set and readback which keep the pace of the batched fet set
+DEFAULT_GAPS = {KIND_ENV: 0.02, KIND_DTL_ENV: 0.01, KIND_FETS: 0.0005, KIND_FET_SET: 0.0005, KIND_DPM_POWER: 0.01}
+
+# Gaps tried by the calibration, slowest first
+CALIBRATION_GAPS = (0.02, 0.01, 0.005, 0.002, 0.001, 0.0005, 0.0002, 0.0)
+# Bursts sent at each gap
+CALIBRATION_ROUNDS = 5
+# Fraction of failed commands, and growth in p95 latency over the slowest gap, that count as overload
+MAX_LOSS = 0.01
+MAX_LATENCY_FACTOR = 3.0
+# The stored gap is the last good gap times this
+SAFETY_FACTOR = 2.0
+# Timeout in seconds for each probe request
+PROBE_TIMEOUT = 0.5
+
+
+def percentile_95(values):
+    """95th percentile of sorted values, None if there are none"""
+    return values[max(0, math.ceil(len(values) * 0.95) - 1)] if values else None
+
+
+class PacingProfile:
+    """Gap in seconds to wait between commands, per channel and command kind"""
+
+    def __init__(self, gaps=None, calibrated=None):
+        """Initializes a PacingProfile
+
+        Args:
+            gaps: {int channel_num : {kind : seconds}}, kinds left out use DEFAULT_GAPS
+            calibrated: When the gaps were measured, None for the defaults
+        """
+        self.gaps = gaps or dict()
+        self.calibrated = calibrated
+
+    @classmethod
+    def load(cls, path=PACING_PATH):
+        """Loads a profile, or returns the defaults if there is no calibrated one"""
+        if not os.path.exists(path):
+            return cls()
+        with open(path) as pacing_file:
+            config = json.load(pacing_file)
+        gaps = {int(channel_num): dict(kinds) for channel_num, kinds in config['gaps'].items()}
+        return cls(gaps, config.get('calibrated'))
+
+    def save(self, path=PACING_PATH):
+        with open(path, 'w') as pacing_file:
+            json.dump({'calibrated': self.calibrated, 'gaps': self.gaps}, pacing_file, indent=4)
+
+    def gap(self, channel_num, kind):
+        return self.gaps.get(channel_num, dict()).get(kind, DEFAULT_GAPS[kind])
+
+    def pace(self, channel_num, kind):
+        """Waits the gap between two commands of a kind on a channel"""
+        gap = self.gap(channel_num, kind)
+        if gap:
+            time.sleep(gap)
+
+
+# Result of the bursts sent at one gap, p95 is the 95th percentile latency in seconds (None if not measured)
+# For bulk reads the latency of a burst is its mean round trip per request, without the gaps
+ProbeResult = namedtuple('ProbeResult', ['gap', 'sent', 'failed', 'p95'])
+
+
+class Calibrator:
+    """Measures the safe command pacing of a channel"""
+
+    def __init__(self, ops, rounds=CALIBRATION_ROUNDS, gaps=CALIBRATION_GAPS):
+        self.logger = logging.getLogger(__name__)
+        self.ops = ops
+        self.rounds = rounds
+        self.gaps = gaps
+
+    def probe_requests(self, requests, gap):
+        """Sends the requests one at a time gap seconds apart, a burst per round, and summarizes how they went"""
+        latencies = list()
+        for _ in range(self.rounds):
+            for request in requests:
+                started = time.monotonic()
+                try:
+                    request()
+                except Exception:  # pylint: disable=broad-except
+                    latencies.append(None)
+                else:
+                    latencies.append(time.monotonic() - started)
+                if gap:
+                    time.sleep(gap)
+        answered = sorted(latency for latency in latencies if latency is not None)
+        return ProbeResult(gap, len(latencies), len(latencies) - len(answered), percentile_95(answered))
+
+    def probe_many(self, read_many, addresses, kind, gap, requests_per_address=1):
+        """Runs a CubeOps bulk read of the addresses per round, with the gap of its kind set to gap
+
+        Args:
+            read_many: Called with the addresses, returns {address: reading or None if it failed}
+            requests_per_address: Requests read_many sends for each address, for the latency
+        """
+        ops = self.ops
+        pacing = ops.pacing
+        ops.pacing = PacingProfile({ops.channel_t: {kind: gap}})
+        sent = failed = 0
+        latencies = list()
+        try:
+            for _ in range(self.rounds):
+                started = time.monotonic()
+                readings = read_many(addresses)
+                elapsed = time.monotonic() - started
+                requests = len(addresses) * requests_per_address
+                latencies.append(max(0.0, elapsed - gap * (requests - 1)) / requests)
+                sent += len(addresses)
+                failed += sum(1 for reading in readings.values() if reading is None)
+        finally:
+            ops.pacing = pacing
+        answered = sorted(latencies) if failed < sent else list()
+        return ProbeResult(gap, sent, failed, percentile_95(answered))
+
+    def probe_fet_set(self, dtl_counts, gap):
+        """Writes each DTL's current counts gap seconds apart, then reads them all back"""
+        sent = failed = 0
+        for _ in range(self.rounds):
+            for address, (fets_5, fets_12) in dtl_counts.items():
+                self.ops.set_dtl_fets(address, fets_5, fets_12)
+                if gap:
+                    time.sleep(gap)
+            readback = self.ops.read_dtl_fets_many(dtl_counts, PROBE_TIMEOUT)
+            sent += len(dtl_counts)
+            failed += sum(1 for address, counts in dtl_counts.items() if readback[address] != counts)
+        return ProbeResult(gap, sent, failed, None)
+
+    def find_safe_gap(self, probe):
+        """Runs probe(gap) at shrinking gaps until it shows overload
+
+        Returns:
+            (safe gap or None if even the slowest gap failed, [ProbeResult])
+            The safe gap is at least SAFETY_FACTOR times the smallest non-zero gap tried, so
+            passing at no gap at all still leaves a margin
+        """
+        results = list()
+        baseline = None
+        last_good = None
+        for gap in self.gaps:
+            result = probe(gap)
+            results.append(result)
+            loss = result.failed / result.sent if result.sent else 1.0
+            if baseline is None and result.p95 is not None:
+                baseline = result.p95
+            overloaded = loss > MAX_LOSS or (result.p95 is not None and baseline is not None
+                                             and result.p95 > baseline * MAX_LATENCY_FACTOR)
+            self.logger.info('gap %.4fs: %d/%d failed, p95 %s%s', gap, result.failed, result.sent,
+                             result.p95, ' OVERLOADED' if overloaded else '')
+            if overloaded:
+                break
+            last_good = gap
+        if last_good is None:
+            return None, results
+        smallest = min((gap for gap in self.gaps if gap > 0), default=0.0)
+        return max(last_good, smallest) * SAFETY_FACTOR, results
+
+    def calibrate(self, dpm_addresses, dtl_addresses, supply_luns):
+        """Measures every kind that can be probed without side effects
+
+        DPM enable/disable can't be read back, so it keeps its default gap.
+
+        Returns:
+            PacingProfile
+        """
+        ops = self.ops
+        gaps = {ops.channel_t: dict(), ops.channel_r: dict()}
+
+        def store(channel_num, kind, probe):
+            self.logger.info('Calibrating %s on channel %d', kind, channel_num)
+            safe_gap, _ = self.find_safe_gap(probe)
+            if safe_gap is None:
+                self.logger.warning('%s on channel %d failed even at the slowest gap, keeping the default',
+                                    kind, channel_num)
+                return
+            gaps[channel_num][kind] = safe_gap
+
+        if dpm_addresses:
+            store(ops.channel_t, KIND_ENV, lambda gap: self.probe_many(
+                lambda addresses: ops.read_dpm_env_many(addresses, PROBE_TIMEOUT), dpm_addresses, KIND_ENV, gap))
+
+        if dtl_addresses:
+            # A DTL readback is an environment and a fet request, it only counts if both answered
+            store(ops.channel_t, KIND_DTL_ENV, lambda gap: self.probe_many(
+                lambda addresses: {address: None if readback is None or readback.fets_5 is None else readback
+                                   for address, readback in ops.read_dtl_many(addresses, PROBE_TIMEOUT).items()},
+                dtl_addresses, KIND_DTL_ENV, gap, requests_per_address=2))
+
+            store(ops.channel_t, KIND_FETS, lambda gap: self.probe_many(
+                lambda addresses: ops.read_dtl_fets_many(addresses, PROBE_TIMEOUT), dtl_addresses, KIND_FETS, gap))
+
+            current = {address: counts for address, counts in ops.read_dtl_fets_many(dtl_addresses).items()
+                       if counts is not None}
+            if current:
+                store(ops.channel_t, KIND_FET_SET, lambda gap: self.probe_fet_set(current, gap))
+
+        if supply_luns:
+            # The supplies all sit behind the PMM address and are swept with read_supply_env
+            supply_requests = [lambda lun=lun: ops.read_supply_env(lun, PROBE_TIMEOUT) for lun in supply_luns]
+            store(ops.channel_r, KIND_ENV, lambda gap: self.probe_requests(supply_requests, gap))
+
+        return PacingProfile(gaps, datetime.now().isoformat(timespec='seconds'))
+
+
+def main():
+    """Calibrate the pacing, or show the current profile"""
+    # cube_ops imports this module, so these can't be imported at the top
+    from spectracan import ChannelManager
+    from cube_ops import CubeOps, CHANNELS, setup_channel
+    from log_pipeline import setup_logging
+    from topology import Topology, TOPOLOGY_FILE, ROLE_DPM, ROLE_DTL
+
+    parser = argparse.ArgumentParser(description='CUBEMELTER command pacing')
+    parser.add_argument('command', choices=['calibrate', 'show'])
+    parser.add_argument('--topology', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                           TOPOLOGY_FILE))
+    parser.add_argument('--output', default=PACING_PATH)
+    parser.add_argument('--device-type', default='kvaser', help='CAN interface to calibrate against')
+    args = parser.parse_args()
+
+    if args.command == 'show':
+        profile = PacingProfile.load(args.output)
+        print('calibrated:', profile.calibrated or 'never, using defaults')
+        for channel_num, (name, _) in CHANNELS.items():
+            print(name, {kind: profile.gap(channel_num, kind) for kind in KINDS})
+        return
+
+    log_listener = setup_logging('CUBEMELTER_pacing.log')
+    try:
+        for channel_num in CHANNELS:
+            setup_channel(channel_num, args.device_type)
+        topology = Topology.load(args.topology)
+        ops = CubeOps()
+        for address in ops.scan([device.address for device in topology.devices]):
+            topology.mark_present(address)
+        profile = Calibrator(ops).calibrate(topology.present(ROLE_DPM), topology.present(ROLE_DTL),
+                                            list(topology.supplies.values()))
+        profile.save(args.output)
+        print('Wrote', args.output, profile.gaps)
+    finally:
+        ChannelManager.shutdown_channels()
+        log_listener.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+##
+# Module with the closed loop power controller used by the CUBEMELTER Tool
+#
+# Given a total power target the controller works out how many 5V and 12V fets each present
+# DTL should load, spreading them so every DBA carries the same share of the heat, applies
+# them with one verified batch and measures the DPM power. The measured power corrects its
+# estimate of what a fet draws, and it repeats until the power is within tolerance.
+#
+# The model is  power = idle + gain * (5V fets * watts_per_fet_5v + 12V fets * watts_per_fet_12v),
+# where idle is what the DPMs draw beyond the fets loaded when the controller starts.
+
+import logging
+import time
+from collections import namedtuple
+
+from topology import ROLE_DPM, ROLE_DTL
+
+# The target counts as reached within this fraction of it, or one 5V fet, whichever is more
+TOLERANCE = 0.02
+MAX_ITERATIONS = 6
+# Seconds to let the load settle after applying fets before measuring
+SETTLE_TIME = 1.0
+# Limits on the correction of the watts per fet estimate
+MIN_GAIN = 0.2
+MAX_GAIN = 5.0
+
+# Outcome of a run
+REACHED = 'reached'                     # measured power within tolerance of the target
+LIMITED_BY_SUPPLY = 'limited_by_supply' # stopped short of the target to keep the supplies under their limit
+NOT_CONVERGED = 'not_converged'         # ran out of iterations or fets
+
+# One step of the controller, powers in watts
+ControlStep = namedtuple('ControlStep', ['iteration', 'goal', 'measured', 'supplies', 'gain', 'allocation'])
+
+# status is REACHED, LIMITED_BY_SUPPLY or NOT_CONVERGED
+ControlResult = namedtuple('ControlResult', ['status', 'target', 'measured', 'allocation', 'history'])
+
+
+class SupplyLimitError(RuntimeError):
+    """A supply limit was given but the supply power couldn't be measured"""
+
+
+def interleave_by_dba(topology, dtl_addresses):
+    """Orders DTLs sled by sled across the DBAs, so spreading load in this order balances the DBAs"""
+    dba_index = {(dba.cube, dba.dba): index for index, dba in enumerate(topology.dbas)}
+
+    def key(address):
+        cube, dba, slot = topology.location[address]
+        return slot, dba_index[(cube, dba)]
+    return sorted(dtl_addresses, key=key)
+
+
+def allocate(fet_watts, order, dtl):
+    """Spreads fet_watts of load over the DTLs
+
+    12V fets carry the bulk of the load and 5V fets make up the remainder. Each kind is dealt
+    out one per DTL in `order`, and the 5V fets start where the 12V fets stopped, so no DTL
+    carries more than one fet of each kind more than another.
+
+    Args:
+        fet_watts: Load to put on the fets
+        order: DTL addresses, see interleave_by_dba
+        dtl: Topology.dtl limits and watts per fet
+
+    Returns:
+        {int dtl_address : (fets_5, fets_12)}
+    """
+    count = len(order)
+    fet_watts = max(0.0, fet_watts)
+    fets_12 = min(int(fet_watts // dtl['watts_per_fet_12v']), dtl['max_fets_12v'] * count)
+    remainder = fet_watts - fets_12 * dtl['watts_per_fet_12v']
+    fets_5 = min(int(round(remainder / dtl['watts_per_fet_5v'])), dtl['max_fets_5v'] * count)
+
+    allocation = dict()
+    for index, address in enumerate(order):
+        twelve = fets_12 // count + (1 if index < fets_12 % count else 0)
+        offset = (index - fets_12 % count) % count
+        five = fets_5 // count + (1 if offset < fets_5 % count else 0)
+        allocation[address] = (five, twelve)
+    return allocation
+
+
+def fet_power(allocation, dtl):
+    """Nominal watts of an allocation"""
+    return sum(five * dtl['watts_per_fet_5v'] + twelve * dtl['watts_per_fet_12v']
+               for five, twelve in allocation.values())
+
+
+class PowerController:
+    """Drives the total DPM power to a target by setting the DTL fets"""
+
+    def __init__(self, ops, topology, settle_time=SETTLE_TIME):
+        """Initializes a PowerController
+
+        Args:
+            ops: CubeOps (or RemoteCubeOps) to measure and set through
+            topology: Topology with the present devices marked
+            settle_time: Seconds to wait after applying fets before measuring
+        """
+        self.logger = logging.getLogger(__name__)
+        self.ops = ops
+        self.topology = topology
+        self.settle_time = settle_time
+
+    def measure(self):
+        """Returns (total DPM watts, {supply_lun : supply DC watts})"""
+        snapshot = self.ops.sweep(self.topology.present(ROLE_DPM), (), list(self.topology.supplies.values()))
+        dpm_power = sum(env['voltage'] * env['current'] for env in snapshot['dpm'].values() if env is not None)
+        supplies = {lun: float(rsp['voltage']) * float(rsp['current'])
+                    for lun, rsp in snapshot['supply'].items() if rsp is not None}
+        return dpm_power, supplies
+
+    def check_supplies(self, supplies, supply_limit):
+        """Raises SupplyLimitError if a limit is given and any supply didn't answer"""
+        if supply_limit is None:
+            return
+        missing = sorted(set(self.topology.supplies.values()) - set(supplies))
+        if not supplies or missing:
+            raise SupplyLimitError('Supply limit of {}W given but no reading from supply LUN(s) {}'.format(
+                supply_limit, ', '.join(hex(lun) for lun in missing) or 'any'))
+
+    def goal(self, target, measured, supplies, supply_limit):
+        """The target, lowered so the most loaded supply stays under supply_limit
+
+        The added load is assumed to spread evenly over the supplies.
+
+        Raises:
+            SupplyLimitError if a limit is given without supply readings
+        """
+        if supply_limit is None:
+            return target
+        if not supplies:
+            raise SupplyLimitError('Supply limit of {}W given but there are no supply readings'.format(supply_limit))
+        headroom = min(supply_limit - power for power in supplies.values())
+        return min(target, measured + headroom * len(supplies))
+
+    def run(self, target, supply_limit=None, max_iterations=MAX_ITERATIONS, progress=None):
+        """Iterates until the DPM power is within tolerance of the target
+
+        Args:
+            target: Total DPM power to reach in watts
+            supply_limit: Optional limit in watts on the DC power of each supply
+            max_iterations: Most allocations to try
+            progress: Optional callback(ControlStep) after each iteration
+
+        Returns:
+            ControlResult
+
+        Raises:
+            ValueError if there are no present DTLs
+            SupplyLimitError if supply_limit is given and a supply reading is missing, the
+            fets are left as the last verified step set them
+        """
+        dtl = self.topology.dtl
+        order = interleave_by_dba(self.topology, self.topology.present(ROLE_DTL))
+        if not order:
+            raise ValueError('No DTLs present, scan first')
+
+        start = self.ops.read_dtl_fets_many(order)
+        allocation = {address: tuple(fets) if fets is not None else (0, 0) for address, fets in start.items()}
+        measured, supplies = self.measure()
+        self.check_supplies(supplies, supply_limit)
+        gain = 1.0
+        idle = max(0.0, measured - fet_power(allocation, dtl))
+        self.logger.info('Power target %.1fW, measured %.1fW with %.1fW idle', target, measured, idle)
+
+        def within(power, reference):
+            return abs(measured - power) <= max(reference * TOLERANCE, dtl['watts_per_fet_5v'] * gain)
+
+        def status(goal):
+            if within(target, target):
+                return REACHED
+            if goal < target and within(goal, goal):
+                return LIMITED_BY_SUPPLY
+            return NOT_CONVERGED
+
+        history = list()
+        goal = target
+        for iteration in range(1, max_iterations + 1):
+            goal = self.goal(target, measured, supplies, supply_limit)
+            proposed = allocate((goal - idle) / gain, order, dtl)
+            if proposed == allocation and history:
+                # One fet more or less is the best it can do
+                break
+            allocation = proposed
+            report = self.ops.set_fets_batch(allocation)
+            applied = {address: tuple(result.applied) if result.applied is not None else allocation[address]
+                       for address, result in report.items()}
+            time.sleep(self.settle_time)
+
+            measured, supplies = self.measure()
+            self.check_supplies(supplies, supply_limit)
+            nominal = fet_power(applied, dtl)
+            if nominal > 0:
+                gain = min(MAX_GAIN, max(MIN_GAIN, (measured - idle) / nominal))
+            step = ControlStep(iteration, goal, measured, supplies, gain, applied)
+            history.append(step)
+            self.logger.info('Iteration %d: goal %.1fW measured %.1fW gain %.2f', iteration, goal, measured, gain)
+            if progress is not None:
+                progress(step)
+
+            if status(goal) != NOT_CONVERGED:
+                return ControlResult(status(goal), target, measured, applied, history)
+
+        return ControlResult(status(goal), target, measured, allocation, history)
@@ -0,0 +1,402 @@
+##
+# Module with the unattended soak runner used by the CUBEMELTER Tool
+#
+# A soak runs the steps of a schedule (see soak_schedule.json), each of which enables or
+# disables the DPMs, loads the present DTLs with a fet count and then sweeps the environment
+# of every present device at a fixed rate for the step's duration. A DTL hotter than the
+# shutoff temperature has its fets set to 0 for the rest of the step, like in the GUI.
+#
+# Only running statistics are kept per sled, so memory doesn't grow with the length of the
+# run. Progress is checkpointed to a json file, and starting the runner again with the same
+# checkpoint resumes the step it was in with the time it had left. At the end a per-sled
+# report is written as json and csv.
+#
+# Usage:
+#   python soak.py run [--schedule FILE] [--pacing FILE] [--checkpoint FILE] [--report FILE] [--fresh]
+#                      [--broker [HOST:PORT]]
+#   python soak.py report [--checkpoint FILE] [--report FILE]
+
+import argparse
+import csv
+import json
+import logging
+import math
+import os
+import time
+from datetime import datetime
+
+from spectracan import ChannelManager
+
+from broker import BrokerClient, RemoteCubeOps, BROKER_HOST, BROKER_PORT
+from cube_ops import CubeOps, CHANNELS, CNUM_CANT, DTL_MAX_TEMP, FET_APPLIED, setup_channel
+from log_pipeline import setup_logging, LOG_FORMATS
+from pacing import PacingProfile, KIND_DPM_POWER, PACING_PATH
+from topology import Topology, TOPOLOGY_FILE, ROLE_DPM, ROLE_DTL
+
+LOG_NAME = 'CUBEMELTER_soak.log'
+SCHEDULE_FILE = 'soak_schedule.json'
+CHECKPOINT_FILE = 'soak_checkpoint.json'
+REPORT_FILE = 'soak_report.json'
+
+# Used for the schedule settings that are left out
+POLL_INTERVAL = 5.0
+CHECKPOINT_INTERVAL = 60.0
+
+# Metrics kept per sled, the DPM power is voltage * current
+METRICS = ('dpm_voltage', 'dpm_current', 'dpm_power', 'dtl_temp', 'dtl_cpu_temp')
+
+
+class RunningStats:
+    """Count, min, max, mean and standard deviation of a metric in constant memory (Welford)"""
+
+    __slots__ = ('count', 'minimum', 'maximum', 'mean', '_m2')
+
+    def __init__(self, count=0, minimum=None, maximum=None, mean=0.0, m2=0.0):
+        self.count = count
+        self.minimum = minimum
+        self.maximum = maximum
+        self.mean = mean
+        self._m2 = m2
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        self.minimum = value if self.minimum is None else min(self.minimum, value)
+        self.maximum = value if self.maximum is None else max(self.maximum, value)
+
+    @property
+    def std(self):
+        return math.sqrt(self._m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+    def to_dict(self):
+        return {'count': self.count, 'min': self.minimum, 'max': self.maximum, 'mean': self.mean, 'm2': self._m2}
+
+    @classmethod
+    def from_dict(cls, state):
+        return cls(state['count'], state['min'], state['max'], state['mean'], state['m2'])
+
+
+def load_schedule(path):
+    """Loads and checks a soak schedule
+
+    Raises:
+        ValueError if a step has no duration or a bad fet count
+    """
+    with open(path) as schedule_file:
+        schedule = json.load(schedule_file)
+    schedule.setdefault('poll_interval', POLL_INTERVAL)
+    schedule.setdefault('checkpoint_interval', CHECKPOINT_INTERVAL)
+    schedule.setdefault('dtl_max_temp', DTL_MAX_TEMP)
+    if not schedule.get('steps'):
+        raise ValueError('The schedule has no steps')
+    for index, step in enumerate(schedule['steps']):
+        step.setdefault('name', 'step{}'.format(index + 1))
+        if step.get('duration', 0) <= 0:
+            raise ValueError('Step {} needs a duration in seconds'.format(step['name']))
+        fets = step.get('fets')
+        if fets is not None and (len(fets) != 2 or min(fets) < 0):
+            raise ValueError('Step {} fets must be [5V fets, 12V fets]'.format(step['name']))
+    return schedule
+
+
+def write_json_atomic(path, data):
+    """Writes json so a crash leaves either the old or the new file, never half of one"""
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as temp_file:
+        json.dump(data, temp_file, indent=2)
+        temp_file.flush()
+        os.fsync(temp_file.fileno())
+    os.replace(temp_path, path)
+
+
+class SoakRunner:
+    """Runs a soak schedule on the present devices and keeps per-sled statistics"""
+
+    def __init__(self, ops, topology, schedule, checkpoint_path=CHECKPOINT_FILE):
+        """Initializes a SoakRunner
+
+        Args:
+            ops: CubeOps (or RemoteCubeOps) to run the soak through
+            topology: Topology with the present devices marked
+            schedule: Schedule dict, see load_schedule
+            checkpoint_path: File the progress is saved to and resumed from
+        """
+        self.logger = logging.getLogger(__name__)
+        self.ops = ops
+        self.topology = topology
+        self.schedule = schedule
+        self.checkpoint_path = checkpoint_path
+        # {sled name : (dpm address, dtl address)}
+        self.sleds = dict()
+        for dba in topology.dbas:
+            for slot in range(1, dba.sleds + 1):
+                name = '{}_DBA{}_SLED{}'.format(dba.cube, dba.dba, slot)
+                self.sleds[name] = (topology.address(dba.cube, dba.dba, slot, ROLE_DPM),
+                                    topology.address(dba.cube, dba.dba, slot, ROLE_DTL))
+        self.state = self.new_state()
+
+    def new_state(self):
+        return {'started': datetime.now().isoformat(timespec='seconds'),
+                'schedule': self.schedule,
+                'step': 0,              # index of the step being run
+                'step_elapsed': 0.0,    # seconds of that step already run
+                'run_seconds': 0.0,     # seconds spent polling over the whole soak
+                'sweeps': 0,
+                'finished': False,
+                'tripped': list(),      # DTLs shut off in the current step
+                'sleds': {name: self.new_sled() for name in self.sleds}}
+
+    @staticmethod
+    def new_sled():
+        return {'polls': 0, 'samples': 0, 'timeouts': 0, 'thermal_trips': 0,
+                'metrics': {metric: RunningStats().to_dict() for metric in METRICS}}
+
+    def resume(self):
+        """Picks up the checkpoint if there is one, returns True if it did
+
+        The schedule stored in the checkpoint wins over the one given, so a resumed soak
+        runs the same steps it started with.
+        """
+        if not os.path.exists(self.checkpoint_path):
+            return False
+        with open(self.checkpoint_path) as checkpoint_file:
+            state = json.load(checkpoint_file)
+        if self.schedule is not None and state['schedule'] != self.schedule:
+            self.logger.warning('Resuming with the schedule stored in %s', self.checkpoint_path)
+        self.schedule = state['schedule']
+        for name in self.sleds:
+            state['sleds'].setdefault(name, self.new_sled())
+        self.state = state
+        self.logger.info('Resuming step %d at %.0fs', state['step'] + 1, state['step_elapsed'])
+        return True
+
+    def checkpoint(self):
+        write_json_atomic(self.checkpoint_path, self.state)
+
+    def set_dpms(self, enabled):
+        for address in self.topology.present(ROLE_DPM):
+            self.ops.pacing.pace(CNUM_CANT, KIND_DPM_POWER)
+            if enabled:
+                self.ops.enable_dpm(address)
+            else:
+                self.ops.disable_dpm(address)
+
+    def set_fets(self, fets, addresses=None):
+        """Loads the DTLs (default all present ones) and logs the ones that didn't apply"""
+        addresses = self.topology.present(ROLE_DTL) if addresses is None else addresses
+        report = self.ops.set_fets_batch({address: tuple(fets) for address in addresses})
+        for address, result in report.items():
+            if result.status != FET_APPLIED:
+                self.logger.warning('DTL %s %s, wanted %s got %s', hex(address), result.status,
+                                    result.requested, result.applied)
+
+    def apply_step(self, step):
+        """Puts the rig in the state a step asks for
+
+        A step that sets fets loads the DTLs tripped in earlier steps again. A resumed step
+        keeps its own tripped DTLs off.
+        """
+        self.logger.info('Step %s for %ss: dpms %s, fets %s', step['name'], step['duration'],
+                         step.get('dpms', 'unchanged'), step.get('fets', 'unchanged'))
+        if 'dpms' in step:
+            self.set_dpms(step['dpms'])
+        fets = step.get('fets')
+        if fets is None:
+            return
+        if not self.state['step_elapsed']:
+            self.state['tripped'] = list()
+        self.set_fets(fets, [address for address in self.topology.present(ROLE_DTL)
+                             if address not in self.state['tripped']])
+
+    def record(self, snapshot):
+        """Adds a sweep to the per-sled statistics and shuts off DTLs that are too hot"""
+        self.state['sweeps'] += 1
+        max_temp = self.schedule['dtl_max_temp']
+        hot = list()
+        for name, (dpm_address, dtl_address) in self.sleds.items():
+            expected = [address for address in (dpm_address, dtl_address) if self.topology.is_present(address)]
+            if not expected:
+                continue
+            sled = self.state['sleds'][name]
+            metrics = sled['metrics']
+            sled['polls'] += 1
+            dpm = snapshot['dpm'].get(dpm_address)
+            dtl = snapshot['dtl'].get(dtl_address)
+            answered = [address for address, reading in ((dpm_address, dpm), (dtl_address, dtl))
+                        if address in expected and reading is not None]
+            sled['timeouts'] += len(expected) - len(answered)
+            if len(answered) == len(expected):
+                sled['samples'] += 1
+
+            values = dict()
+            if dpm is not None:
+                values.update(dpm_voltage=dpm['voltage'], dpm_current=dpm['current'],
+                              dpm_power=dpm['voltage'] * dpm['current'])
+            if dtl is not None:
+                values.update(dtl_temp=dtl['temp'], dtl_cpu_temp=dtl['cpu_temp'])
+            for metric, value in values.items():
+                stats = RunningStats.from_dict(metrics[metric])
+                stats.add(float(value))
+                metrics[metric] = stats.to_dict()
+
+            if dtl is not None and dtl['temp'] > max_temp and dtl_address not in self.state['tripped']:
+                sled['thermal_trips'] += 1
+                self.state['tripped'].append(dtl_address)
+                hot.append(dtl_address)
+                self.logger.warning('%s DTL %s at %s°C, shutting off its fets', name, hex(dtl_address), dtl['temp'])
+        if hot:
+            self.set_fets((0, 0), hot)
+
+    def poll(self):
+        self.record(self.ops.sweep(self.topology.present(ROLE_DPM), self.topology.present(ROLE_DTL),
+                                   list(self.topology.supplies.values())))
+
+    def run(self):
+        """Runs the schedule from where the state says, returns True once it has finished
+
+        Interrupting it (Ctrl-C) saves a checkpoint and unloads the DTLs, so it can be resumed.
+        """
+        steps = self.schedule['steps']
+        interval = self.schedule['poll_interval']
+        last_checkpoint = time.monotonic()
+        try:
+            while self.state['step'] < len(steps):
+                step = steps[self.state['step']]
+                self.apply_step(step)
+                self.checkpoint()
+                next_poll = last_tick = time.monotonic()
+                while self.state['step_elapsed'] < step['duration']:
+                    self.poll()
+                    now = time.monotonic()
+                    # Fixed rate, but a poll that overran its slot doesn't cause a burst to catch up
+                    next_poll = max(next_poll + interval, now)
+                    time.sleep(max(0.0, min(next_poll, now + step['duration'] - self.state['step_elapsed']) - now))
+                    now = time.monotonic()
+                    self.state['step_elapsed'] += now - last_tick
+                    self.state['run_seconds'] += now - last_tick
+                    last_tick = now
+                    if now - last_checkpoint >= self.schedule['checkpoint_interval']:
+                        self.checkpoint()
+                        last_checkpoint = now
+                self.state['step'] += 1
+                self.state['step_elapsed'] = 0.0
+            self.state['finished'] = True
+            return True
+        except KeyboardInterrupt:
+            self.logger.info('Soak interrupted in step %d, run it again to resume', self.state['step'] + 1)
+            return False
+        finally:
+            self.checkpoint()
+            # If the run died of a bus or broker error this may fail too, don't hide the original error
+            try:
+                self.set_fets((0, 0))
+            except Exception:  # pylint: disable=broad-except
+                self.logger.exception('Could not unload the DTLs at the end of the soak')
+
+    def report(self):
+        """Per-sled results of the soak so far
+
+        Returns:
+            {'started', 'finished', 'run_seconds', 'sweeps',
+             'sleds': {sled name: {'dpm', 'dtl', 'polls', 'samples', 'poll_rate', 'timeouts',
+                                   'thermal_trips', metric: {'min', 'max', 'mean', 'std'}}}}
+            poll_rate is the samples per second over the time spent polling
+            Sleds in the checkpoint that aren't in the topology are left out
+        """
+        run_seconds = self.state['run_seconds']
+        sleds = dict()
+        for name, sled in self.state['sleds'].items():
+            if not sled['polls']:
+                continue
+            if name not in self.sleds:
+                self.logger.warning('%s is in the checkpoint but not in the topology, leaving it out', name)
+                continue
+            dpm_address, dtl_address = self.sleds[name]
+            entry = {'dpm': hex(dpm_address), 'dtl': hex(dtl_address),
+                     'polls': sled['polls'], 'samples': sled['samples'],
+                     'poll_rate': sled['samples'] / run_seconds if run_seconds else 0.0,
+                     'timeouts': sled['timeouts'], 'thermal_trips': sled['thermal_trips']}
+            for metric in METRICS:
+                stats = RunningStats.from_dict(sled['metrics'][metric])
+                entry[metric] = {'min': stats.minimum, 'max': stats.maximum,
+                                 'mean': stats.mean if stats.count else None, 'std': stats.std}
+            sleds[name] = entry
+        return {'started': self.state['started'], 'finished': self.state['finished'],
+                'run_seconds': run_seconds, 'sweeps': self.state['sweeps'], 'sleds': sleds}
+
+
+def write_report(report, path):
+    """Writes the report as json, and one row per sled to a csv next to it"""
+    write_json_atomic(path, report)
+    columns = ['sled', 'dpm', 'dtl', 'polls', 'samples', 'poll_rate', 'timeouts', 'thermal_trips']
+    columns += ['{}_{}'.format(metric, stat) for metric in METRICS for stat in ('min', 'max', 'mean', 'std')]
+    with open(os.path.splitext(path)[0] + '.csv', 'w', newline='') as csv_file:
+        writer = csv.DictWriter(csv_file, columns)
+        writer.writeheader()
+        for name, sled in report['sleds'].items():
+            row = {column: sled[column] for column in columns[1:8]}
+            row['sled'] = name
+            for metric in METRICS:
+                for stat, value in sled[metric].items():
+                    row['{}_{}'.format(metric, stat)] = value
+            writer.writerow(row)
+
+
+def main():
+    """Run a soak, or write the report of the checkpointed one"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='CUBEMELTER soak runner')
+    parser.add_argument('command', choices=['run', 'report'])
+    parser.add_argument('--topology', default=os.path.join(here, TOPOLOGY_FILE))
+    parser.add_argument('--schedule', default=os.path.join(here, SCHEDULE_FILE))
+    parser.add_argument('--pacing', default=PACING_PATH, help='calibrated pacing profile')
+    parser.add_argument('--checkpoint', default=CHECKPOINT_FILE)
+    parser.add_argument('--report', default=REPORT_FILE)
+    parser.add_argument('--fresh', action='store_true', help='ignore an existing checkpoint')
+    parser.add_argument('--broker', nargs='?', const='{}:{}'.format(BROKER_HOST, BROKER_PORT),
+                        help='run through a broker instead of owning the CAN channels')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    parser.add_argument('--log-format', default='text', choices=LOG_FORMATS)
+    args = parser.parse_args()
+
+    topology = Topology.load(args.topology)
+    if args.command == 'report':
+        runner = SoakRunner(None, topology, None, args.checkpoint)
+        if not runner.resume():
+            parser.error('No checkpoint at ' + args.checkpoint)
+        write_report(runner.report(), args.report)
+        return
+
+    log_listener = setup_logging(LOG_NAME, args.log_level, args.log_format)
+    ops = None
+    try:
+        if args.broker:
+            host, _, port = args.broker.rpartition(':')
+            ops = RemoteCubeOps(BrokerClient(host or BROKER_HOST, int(port)), PacingProfile.load(args.pacing))
+        else:
+            for channel_num in CHANNELS:
+                setup_channel(channel_num)
+            ops = CubeOps(pacing=PacingProfile.load(args.pacing))
+        for address in ops.scan([device.address for device in topology.devices]):
+            topology.mark_present(address)
+        runner = SoakRunner(ops, topology, load_schedule(args.schedule), args.checkpoint)
+        if args.fresh or not runner.resume():
+            runner.checkpoint()
+        if runner.state['finished']:
+            print('The soak in', args.checkpoint, 'has finished, use --fresh to start another')
+        elif runner.run():
+            print('Soak finished')
+        write_report(runner.report(), args.report)
+        print('Wrote', args.report)
+    finally:
+        if ops is not None:
+            ops.close()
+        if not args.broker:
+            ChannelManager.shutdown_channels()
+        log_listener.stop()
+
+
+if __name__ == '__main__':
+    main()
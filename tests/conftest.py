@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from topology import Topology  # noqa: E402
+
+
+@pytest.fixture
+def topology():
+    """Two DBAs of four sleds, every device present"""
+    topology = Topology({'sleds_per_dba': 4,
+                         'cubes': [{'name': 'Cube1', 'dbas': [{'dba': 1}, {'dba': 2}]}],
+                         'supplies': {'Supply0': '0x01', 'Supply1': '0x02', 'Supply2': '0x03'}})
+    for device in topology.devices:
+        topology.mark_present(device.address)
+    return topology
@@ -0,0 +1,72 @@
+import numpy as np
+
+from anomaly import AnomalyDetector, robust_z
+from topology import ROLE_DPM, ROLE_DTL
+
+
+def dpm_readings(topology, current=1.5, voltage=12.0):
+    return {address: {'voltage': voltage, 'current': current} for address in topology.present(ROLE_DPM)}
+
+
+def dtl_readings(topology, temps):
+    return {address: {'temp': temps.get(address, 40)} for address in topology.present(ROLE_DTL)}
+
+
+def kinds(anomalies):
+    return {(anomaly.kind, anomaly.address) for anomaly in anomalies}
+
+
+def test_robust_z_ignores_nan():
+    z = robust_z(np.array([1.0, 1.0, 1.0, np.nan, 10.0]), 0.05)
+    assert np.isnan(z[3])
+    assert z[4] > 3.5
+    assert abs(z[0]) < 1e-9
+
+
+def test_current_spike_is_flagged(topology):
+    detector = AnomalyDetector(topology)
+    dpms = dpm_readings(topology)
+    dpms[0x02]['current'] = 6.0
+    assert kinds(detector.check({'time': 0.0, 'dpm': dpms})) == {('current_spike', 0x02)}
+
+
+def test_uniform_fleet_is_quiet(topology):
+    detector = AnomalyDetector(topology)
+    for second in range(3):
+        snapshot = {'time': float(second), 'dpm': dpm_readings(topology), 'dtl': dtl_readings(topology, {})}
+        assert detector.check(snapshot) == []
+
+
+def test_dtl_sweep_after_dpm_sweep_has_no_false_rise(topology):
+    detector = AnomalyDetector(topology)
+    assert detector.check({'time': 0.0, 'dpm': dpm_readings(topology)}) == []
+    assert detector.check({'time': 1.0, 'dtl': dtl_readings(topology, {})}) == []
+
+
+def test_rates_use_each_cells_own_last_reading(topology):
+    detector = AnomalyDetector(topology)
+    detector.check({'time': 0.0, 'dtl': dtl_readings(topology, {})})
+    # A DPM only sweep in between doesn't reset the DTL temperatures
+    detector.check({'time': 10.0, 'dpm': dpm_readings(topology)})
+    anomalies = detector.check({'time': 20.0, 'dtl': dtl_readings(topology, {0x81: 70})})
+    rising = [anomaly for anomaly in anomalies if anomaly.kind == 'temp_rising']
+    assert [anomaly.address for anomaly in rising] == [0x81]
+    assert rising[0].value == 1.5
+
+
+def test_missing_readings_are_not_zero(topology):
+    detector = AnomalyDetector(topology)
+    dtls = dtl_readings(topology, {})
+    dtls[0x80] = None
+    del dtls[0x81]
+    assert detector.check({'time': 0.0, 'dtl': dtls}) == []
+
+
+def test_power_mismatch(topology):
+    detector = AnomalyDetector(topology)
+    # 8 DPMs at 18W against 3 supplies at 96W each
+    supplies = {lun: {'voltage': 12.0, 'current': 8.0} for lun in topology.supplies.values()}
+    assert kinds(detector.check({'time': 0.0, 'dpm': dpm_readings(topology), 'supply': supplies})) == {
+        ('power_mismatch', None)}
+    supplies = {lun: {'voltage': 12.0, 'current': 4.0} for lun in topology.supplies.values()}
+    assert detector.check({'time': 1.0, 'dpm': dpm_readings(topology), 'supply': supplies}) == []
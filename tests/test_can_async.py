@@ -0,0 +1,75 @@
+import asyncio
+import time
+
+import pytest
+
+pytest.importorskip('spectracan')
+
+import can_async  # noqa: E402
+from can_async import AsyncTransport  # noqa: E402
+from cube_ops import CNUM_CANT  # noqa: E402
+
+
+def test_transport_built_before_the_loop():
+    transport = AsyncTransport(max_in_flight=1)
+
+    async def main():
+        started = time.monotonic()
+        # The second call has to wait for the first one's slot
+        await asyncio.gather(transport.run(CNUM_CANT, time.sleep, 0.05),
+                             transport.run(CNUM_CANT, time.sleep, 0.05))
+        return time.monotonic() - started
+
+    try:
+        assert asyncio.run(main()) >= 0.1
+        # A transport can be used from a second loop as well
+        assert asyncio.run(main()) >= 0.1
+        assert transport.in_flight(CNUM_CANT) == 0
+    finally:
+        transport.close()
+
+
+def test_timed_out_call_keeps_its_slot():
+    transport = AsyncTransport(max_in_flight=1)
+
+    async def main():
+        with pytest.raises(asyncio.TimeoutError):
+            await transport.run(CNUM_CANT, time.sleep, 0.1, timeout=0.02)
+        assert transport.in_flight(CNUM_CANT) == 1
+        await asyncio.sleep(0.15)
+        assert transport.in_flight(CNUM_CANT) == 0
+
+    try:
+        asyncio.run(main())
+    finally:
+        transport.close()
+
+
+class FakeSender:
+    """Stands in for MsgSender, counts the sync requests running at once"""
+
+    def __init__(self):
+        self.active = 0
+        self.most_active = 0
+
+    def send_command_sync(self, channel_num, src, dest, command, timeout):
+        self.active += 1
+        self.most_active = max(self.most_active, self.active)
+        time.sleep(0.01)
+        self.active -= 1
+        return bytes([dest])
+
+
+def test_gathered_requests_are_serialized(monkeypatch):
+    sender = FakeSender()
+    monkeypatch.setattr(can_async, 'MsgSender', sender)
+    transport = AsyncTransport()
+
+    async def main():
+        return await asyncio.gather(*(transport.request(address, [0x10]) for address in range(8)))
+
+    try:
+        assert asyncio.run(main()) == [bytes([address]) for address in range(8)]
+    finally:
+        transport.close()
+    assert sender.most_active == 1
@@ -0,0 +1,155 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('spectracan')
+
+import cube_ops  # noqa: E402
+from cube_ops import (CubeOps, ArbitraryCommand, CNUM_CANT, CMD_GET_ENV, CMD_GET_FETS, DTL_FET_PAYLOAD,  # noqa: E402
+                      DTL_FET_GET, DTL_FET_SET, FET_APPLIED, FET_MISMATCHED, FET_MISSING)
+from pacing import PacingProfile, KINDS, KIND_DTL_ENV  # noqa: E402
+from spectracan.can_commands import LCFCmd_GetEnvironment  # noqa: E402
+from spectracan.error import CanTimeoutError  # noqa: E402
+
+DTLS = (0x80, 0x81, 0x82, 0x83)
+
+
+class FakeBus:
+    """Stands in for MsgSender, answers like a set of DTLs"""
+
+    def __init__(self, dtls=DTLS):
+        self.fets = {address: (0, 0) for address in dtls}
+        self.temps = {address: 40 for address in dtls}
+        self.silent = set()         # DTLs that never answer
+        self.short = set()          # DTLs that answer with a truncated response
+        self.drop_sets = dict()     # {address : set frames it ignores}
+        self.max_fets = dict()      # {address : (5V fets, 12V fets) it can't go past}
+        self.requests = list()
+        self.delay = 0.0
+        self.active = 0
+        self.most_active = 0
+
+    def send_command_no_response(self, channel_num, src, dest, command):
+        command = list(command)
+        if command[-4:-2] != [DTL_FET_PAYLOAD[1], DTL_FET_SET] or dest not in self.fets:
+            return
+        if self.drop_sets.get(dest):
+            self.drop_sets[dest] -= 1
+            return
+        limit = self.max_fets.get(dest, (8, 8))
+        self.fets[dest] = (min(command[-2], limit[0]), min(command[-1], limit[1]))
+
+    def send_command_sync(self, channel_num, src, dest, command, timeout):
+        command = list(command)
+        self.requests.append((dest, command))
+        self.active += 1
+        self.most_active = max(self.most_active, self.active)
+        time.sleep(self.delay)
+        self.active -= 1
+        if dest in self.silent or dest not in self.fets:
+            raise CanTimeoutError('No response from {}'.format(hex(dest)))
+        if dest in self.short:
+            return bytes([0, 1])
+        if command[-2:] == [DTL_FET_PAYLOAD[1], DTL_FET_GET]:
+            return bytes([0, *self.fets[dest]])
+        return bytes([0] * 8 + [self.temps[dest], 50, 0, 0])
+
+
+@pytest.fixture
+def bus(monkeypatch):
+    bus = FakeBus()
+    monkeypatch.setattr(cube_ops, 'MsgSender', bus)
+    return bus
+
+
+@pytest.fixture
+def ops(bus):
+    return CubeOps(pacing=PacingProfile({CNUM_CANT: {kind: 0.0 for kind in KINDS}}))
+
+
+def test_request_many(bus, ops):
+    bus.silent.add(0x81)
+    bus.fets[0x80] = (3, 5)
+    env_command = LCFCmd_GetEnvironment.build_command()
+    fets_command = ArbitraryCommand.build_command(payload=DTL_FET_PAYLOAD + [DTL_FET_GET])
+    requests = [(0x80, env_command, CMD_GET_ENV), (0x80, fets_command, CMD_GET_FETS),
+                (0x81, env_command, CMD_GET_ENV)]
+
+    responses = ops.request_many(requests, 0.1, KIND_DTL_ENV)
+    assert responses[(0x81, CMD_GET_ENV)] is None
+    assert responses[(0x80, CMD_GET_ENV)][0][8] == 40
+    assert list(responses[(0x80, CMD_GET_FETS)][0]) == [0, 3, 5]
+    assert len(bus.requests) == 3
+
+    # Fresh enough readings come from the cache, the missing one is asked for again
+    bus.fets[0x80] = (1, 1)
+    responses = ops.request_many(requests, 0.1, KIND_DTL_ENV, max_age=10)
+    assert list(responses[(0x80, CMD_GET_FETS)][0]) == [0, 3, 5]
+    assert [dest for dest, _ in bus.requests[3:]] == [0x81]
+
+    readbacks = ops.read_dtl_many([0x80, 0x81])
+    assert readbacks[0x81] is None
+    assert (readbacks[0x80].temp, readbacks[0x80].fets_5, readbacks[0x80].fets_12) == (40, 1, 1)
+
+
+def test_malformed_responses_are_missing(bus, ops):
+    bus.short.add(0x81)
+    readbacks = ops.read_dtl_many([0x80, 0x81])
+    assert readbacks[0x81] is None and readbacks[0x80].temp == 40
+    assert ops.read_dtl_fets_many([0x80, 0x81]) == {0x80: (0, 0), 0x81: None}
+    snapshot = ops.sweep(dtl_addresses=[0x80, 0x81])
+    assert snapshot['dtl'][0x81] is None
+    with pytest.raises(ValueError):
+        ops.read_dtl_env(0x81)
+    assert ops.set_fets_batch({0x81: (1, 1)}, retries=0)[0x81].status == FET_MISSING
+
+
+def test_request_many_joins_reads_in_flight(bus, ops):
+    bus.delay = 0.1
+    single = threading.Thread(target=ops.read_dtl_env, args=(0x80,))
+    single.start()
+    time.sleep(0.03)
+    readbacks = ops.read_dtl_many([0x80])
+    single.join()
+    assert readbacks[0x80].temp == 40
+    # The environment request was shared, only the fet read went out again
+    assert [(dest, command[-2:]) for dest, command in bus.requests] == \
+        [(0x80, list(LCFCmd_GetEnvironment.build_command())[-2:]), (0x80, [DTL_FET_PAYLOAD[1], DTL_FET_GET])]
+    assert ops.cache.snapshot_stats()['coalesced'] == 1
+
+
+def test_set_fets_batch(bus, ops):
+    bus.silent.add(0x81)
+    bus.max_fets[0x82] = (8, 2)
+    bus.drop_sets[0x83] = 1
+    report = ops.set_fets_batch({address: (4, 4) for address in DTLS}, retries=2)
+
+    assert report[0x80].status == FET_APPLIED and report[0x80].attempts == 1
+    assert report[0x81].status == FET_MISSING and report[0x81].applied is None
+    assert report[0x82].status == FET_MISMATCHED and report[0x82].applied == (4, 2)
+    assert report[0x82].attempts == 3
+    # Only the DTLs that failed are sent to again, the dropped frame is fixed by the retry
+    assert report[0x83].status == FET_APPLIED and report[0x83].attempts == 2
+    readbacks = [dest for dest, _ in bus.requests]
+    assert readbacks.count(0x80) == 1 and readbacks.count(0x83) == 2 and readbacks.count(0x82) == 3
+
+
+def test_set_fets_batch_reads_past_the_cache(bus, ops):
+    assert ops.read_dtl_fets(0x80) == (0, 0)
+    report = ops.set_fets_batch({0x80: (2, 6)})
+    assert report[0x80].status == FET_APPLIED
+    assert ops.read_dtl_fets(0x80, max_age=10) == (2, 6)
+
+
+def test_sync_requests_on_a_channel_are_serialized(bus, ops):
+    bus.delay = 0.01
+    other = CubeOps(pacing=ops.pacing)
+    threads = [threading.Thread(target=ops.sweep, kwargs={'dtl_addresses': DTLS}),
+               threading.Thread(target=other.set_fets_batch, args=({address: (1, 1) for address in DTLS},)),
+               threading.Thread(target=other.read_dtl_fets, args=(0x80,))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert bus.most_active == 1
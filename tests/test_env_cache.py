@@ -0,0 +1,110 @@
+import threading
+import time
+
+import pytest
+
+from env_cache import EnvCache
+
+KEY = (1, 0x80, None, 'GetEnvironment')
+
+
+def slow_fetch(value, delay, calls):
+    def fetch():
+        calls.append(value)
+        time.sleep(delay)
+        return value
+    return fetch
+
+
+def read_concurrently(cache, count, fetch, **kwargs):
+    results, errors = list(), list()
+
+    def reader():
+        try:
+            results.append(cache.read(KEY, fetch, **kwargs))
+        except Exception as err:  # pylint: disable=broad-except
+            errors.append(err)
+    threads = [threading.Thread(target=reader) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.005)
+    for thread in threads:
+        thread.join()
+    return results, errors
+
+
+def test_concurrent_reads_share_one_fetch():
+    cache, calls = EnvCache(), list()
+    results, errors = read_concurrently(cache, 5, slow_fetch('env', 0.1, calls))
+    assert calls == ['env']
+    assert results == ['env'] * 5 and not errors
+    stats = cache.snapshot_stats()
+    assert (stats['misses'], stats['coalesced']) == (1, 4)
+    assert stats['saved_fraction'] == pytest.approx(0.8)
+
+
+def test_max_age_zero_always_fetches_again():
+    cache, calls = EnvCache(), list()
+    cache.read(KEY, slow_fetch(1, 0, calls))
+    cache.read(KEY, slow_fetch(2, 0, calls))
+    assert calls == [1, 2]
+
+
+def test_fresh_value_is_served_from_cache():
+    cache, calls = EnvCache(), list()
+    cache.read(KEY, slow_fetch(1, 0, calls))
+    assert cache.read(KEY, slow_fetch(2, 0, calls), max_age=10) == 1
+    assert calls == [1]
+    time.sleep(0.02)
+    assert cache.read(KEY, slow_fetch(3, 0, calls), max_age=0.01) == 3
+
+
+def test_fetch_error_reaches_every_waiter():
+    cache = EnvCache()
+
+    def fetch():
+        time.sleep(0.05)
+        raise IOError('bus off')
+    results, errors = read_concurrently(cache, 3, fetch)
+    assert not results and len(errors) == 3
+    assert all(isinstance(err, IOError) for err in errors)
+    # The failed read isn't left in flight
+    assert cache.read(KEY, lambda: 'ok') == 'ok'
+
+
+def test_waiter_gives_up_after_its_own_timeout():
+    cache, calls = EnvCache(), list()
+    owner = threading.Thread(target=cache.read, args=(KEY, slow_fetch('env', 0.5, calls)))
+    owner.start()
+    time.sleep(0.02)
+    started = time.monotonic()
+    with pytest.raises(TimeoutError):
+        cache.read(KEY, slow_fetch('other', 0, calls), timeout=0.05)
+    assert time.monotonic() - started < 0.3
+    owner.join()
+
+
+def test_invalidate_drops_value_and_stops_sharing():
+    cache, calls = EnvCache(), list()
+    cache.read(KEY, slow_fetch(1, 0, calls))
+    cache.invalidate(KEY)
+    assert cache.read(KEY, slow_fetch(2, 0, calls), max_age=10) == 2
+
+    # A read that was in flight when the key was invalidated isn't stored or shared
+    owner = threading.Thread(target=cache.read, args=(KEY, slow_fetch(3, 0.1, calls)))
+    owner.start()
+    time.sleep(0.02)
+    cache.invalidate(KEY)
+    assert cache.read(KEY, slow_fetch(4, 0, calls)) == 4
+    owner.join()
+    assert cache.read(KEY, slow_fetch(5, 0, calls), max_age=10) == 4
+
+
+def test_read_timed():
+    cache = EnvCache()
+    value, read_time = cache.read_timed(KEY, lambda: b'\x00\x01')
+    assert value == b'\x00\x01'
+    assert abs(read_time - time.time()) < 1
+    time.sleep(0.01)
+    # A cached value keeps the time it was read
+    assert cache.read_timed(KEY, lambda: b'\x02', max_age=10) == (value, read_time)
@@ -0,0 +1,72 @@
+from pacing import Calibrator, PacingProfile, ProbeResult, DEFAULT_GAPS, KIND_DTL_ENV, KIND_ENV, SAFETY_FACTOR
+
+GAPS = (0.02, 0.01, 0.001, 0.0)
+
+
+def probe_failing_below(limit):
+    def probe(gap):
+        return ProbeResult(gap, 100, 0 if gap >= limit else 50, 0.01)
+    return probe
+
+
+def test_safe_gap_is_last_good_gap_with_margin():
+    safe_gap, results = Calibrator(None, gaps=GAPS).find_safe_gap(probe_failing_below(0.01))
+    assert safe_gap == 0.01 * SAFETY_FACTOR
+    assert [result.gap for result in results] == [0.02, 0.01, 0.001]
+
+
+def test_passing_at_no_gap_keeps_a_margin():
+    safe_gap, _ = Calibrator(None, gaps=GAPS).find_safe_gap(probe_failing_below(0.0))
+    assert safe_gap == 0.001 * SAFETY_FACTOR
+
+
+def test_failing_at_slowest_gap_gives_none():
+    safe_gap, _ = Calibrator(None, gaps=GAPS).find_safe_gap(probe_failing_below(1.0))
+    assert safe_gap is None
+
+
+def test_latency_growth_counts_as_overload():
+    def probe(gap):
+        return ProbeResult(gap, 100, 0, 0.01 if gap >= 0.01 else 0.05)
+    safe_gap, _ = Calibrator(None, gaps=GAPS).find_safe_gap(probe)
+    assert safe_gap == 0.01 * SAFETY_FACTOR
+
+
+def test_profile_defaults_keep_the_hand_tuned_sleeps(tmp_path):
+    profile = PacingProfile.load(str(tmp_path / 'missing.json'))
+    assert profile.gap(0, KIND_ENV) == DEFAULT_GAPS[KIND_ENV] == 0.02
+    assert profile.gap(1, KIND_DTL_ENV) == 0.01
+    path = str(tmp_path / 'pacing.json')
+    PacingProfile({1: {KIND_ENV: 0.003}}, 'now').save(path)
+    loaded = PacingProfile.load(path)
+    assert loaded.gap(1, KIND_ENV) == 0.003
+    assert loaded.gap(1, KIND_DTL_ENV) == 0.01
+
+
+class FakeOps:
+    """Bulk reads that lose responses when the gap they are paced with is below min_gap"""
+
+    channel_t = 1
+
+    def __init__(self, min_gap):
+        self.min_gap = min_gap
+        self.pacing = PacingProfile()
+        self.gaps_used = list()
+
+    def read_dpm_env_many(self, addresses, timeout):
+        gap = self.pacing.gap(self.channel_t, KIND_ENV)
+        self.gaps_used.append(gap)
+        return {address: None if gap < self.min_gap else {'voltage': 12.0} for address in addresses}
+
+
+def test_probe_many_paces_the_bulk_read():
+    ops = FakeOps(min_gap=0.005)
+    pacing = ops.pacing
+    calibrator = Calibrator(ops, rounds=2, gaps=GAPS)
+    safe_gap, results = calibrator.find_safe_gap(
+        lambda gap: calibrator.probe_many(lambda addresses: ops.read_dpm_env_many(addresses, 0.1),
+                                          [0, 1, 2], KIND_ENV, gap))
+    assert safe_gap == 0.01 * SAFETY_FACTOR
+    assert ops.gaps_used == [0.02, 0.02, 0.01, 0.01, 0.001, 0.001]
+    assert results[-1].failed == results[-1].sent == 6 and results[-1].p95 is None
+    assert ops.pacing is pacing
@@ -0,0 +1,92 @@
+from collections import namedtuple
+
+import pytest
+
+from power_control import (PowerController, SupplyLimitError, allocate, fet_power, interleave_by_dba,
+                           REACHED, LIMITED_BY_SUPPLY)
+from topology import ROLE_DPM, ROLE_DTL
+
+FetResult = namedtuple('FetResult', ['status', 'requested', 'applied', 'attempts'])
+
+
+class FakePlant:
+    """Ops whose DPM power is idle + gain * nominal fet watts, split evenly over the supplies"""
+
+    def __init__(self, topology, idle=100.0, gain=1.3, supplies_answer=True):
+        self.topology = topology
+        self.idle = idle
+        self.gain = gain
+        self.supplies_answer = supplies_answer
+        self.fets = {address: (0, 0) for address in topology.present(ROLE_DTL)}
+
+    def power(self):
+        return self.idle + self.gain * fet_power(self.fets, self.topology.dtl)
+
+    def read_dtl_fets_many(self, addresses):
+        return {address: self.fets[address] for address in addresses}
+
+    def set_fets_batch(self, targets):
+        self.fets.update(targets)
+        return {address: FetResult('applied', fets, fets, 1) for address, fets in targets.items()}
+
+    def sweep(self, dpm_addresses, dtl_addresses, supply_luns):
+        dpm_current = self.power() / 12.0 / len(dpm_addresses)
+        per_supply = self.power() / len(supply_luns)
+        return {'dpm': {address: {'voltage': 12.0, 'current': dpm_current} for address in dpm_addresses},
+                'dtl': dict(),
+                'supply': {lun: {'voltage': 12.0, 'current': per_supply / 12.0} if self.supplies_answer else None
+                           for lun in supply_luns}}
+
+
+def test_allocate_spreads_fets_evenly(topology):
+    order = interleave_by_dba(topology, topology.present(ROLE_DTL))
+    allocation = allocate(12.0 * 10 + 5.0 * 2, order, topology.dtl)
+    assert sum(twelve for _, twelve in allocation.values()) == 10
+    assert sum(five for five, _ in allocation.values()) == 2
+    loads = [five + twelve for five, twelve in allocation.values()]
+    assert max(loads) - min(loads) <= 1
+
+
+def test_allocate_caps_at_max_fets(topology):
+    order = topology.present(ROLE_DTL)
+    allocation = allocate(1e9, order, topology.dtl)
+    assert all(allocation[address] == (8, 8) for address in order)
+
+
+def test_interleave_alternates_dbas(topology):
+    order = interleave_by_dba(topology, topology.present(ROLE_DTL))
+    assert [topology.location[address][1] for address in order[:4]] == [1, 2, 1, 2]
+
+
+def test_reaches_target(topology):
+    plant = FakePlant(topology)
+    result = PowerController(plant, topology, settle_time=0).run(800.0)
+    assert result.status == REACHED
+    assert abs(result.measured - 800.0) <= 800.0 * 0.02 + 5.0 * 2
+
+
+def test_supply_limit_is_reported_as_limited(topology):
+    plant = FakePlant(topology)
+    result = PowerController(plant, topology, settle_time=0).run(2000.0, supply_limit=200.0)
+    assert result.status == LIMITED_BY_SUPPLY
+    assert plant.power() / 3 <= 200.0 * 1.05
+
+
+def test_supply_limit_fails_closed_without_supply_readings(topology):
+    plant = FakePlant(topology, supplies_answer=False)
+    with pytest.raises(SupplyLimitError):
+        PowerController(plant, topology, settle_time=0).run(2000.0, supply_limit=200.0)
+    assert plant.power() == plant.idle
+
+
+def test_no_limit_runs_without_supply_readings(topology):
+    plant = FakePlant(topology, supplies_answer=False)
+    assert PowerController(plant, topology, settle_time=0).run(500.0).status == REACHED
+
+
+def test_measure_sums_dpm_power(topology):
+    plant = FakePlant(topology, idle=240.0)
+    measured, supplies = PowerController(plant, topology).measure()
+    assert measured == pytest.approx(240.0)
+    assert len(supplies) == len(topology.supplies)
+    assert len(topology.present(ROLE_DPM)) == 8
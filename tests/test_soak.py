@@ -0,0 +1,154 @@
+import csv
+import json
+import statistics
+
+import pytest
+
+pytest.importorskip('spectracan')
+
+from cube_ops import FetResult, FET_APPLIED  # noqa: E402
+from soak import RunningStats, SoakRunner, write_report, METRICS  # noqa: E402
+from topology import Topology, ROLE_DPM, ROLE_DTL  # noqa: E402
+
+
+class FakePacing:
+    def pace(self, channel_num, kind):
+        pass
+
+
+class FakeOps:
+    """Answers sweeps with fixed readings, one DTL can be made hot"""
+
+    def __init__(self, hot=None):
+        self.pacing = FakePacing()
+        self.hot = hot
+        self.fets = dict()
+        self.dpms = None
+        self.sweeps = 0
+
+    def enable_dpm(self, address):
+        self.dpms = True
+
+    def disable_dpm(self, address):
+        self.dpms = False
+
+    def set_fets_batch(self, targets):
+        self.fets.update(targets)
+        return {address: FetResult(FET_APPLIED, fets, fets, 1) for address, fets in targets.items()}
+
+    def sweep(self, dpm_addresses, dtl_addresses, supply_luns):
+        self.sweeps += 1
+        return {'dpm': {address: {'voltage': 12.0, 'current': 2.0} for address in dpm_addresses},
+                'dtl': {address: {'temp': 120 if address == self.hot else 40, 'cpu_temp': 50}
+                        for address in dtl_addresses},
+                'supply': dict()}
+
+
+def schedule(*durations):
+    return {'poll_interval': 0.005, 'checkpoint_interval': 60, 'dtl_max_temp': 90,
+            'steps': [{'name': 'step{}'.format(index), 'duration': duration, 'dpms': True, 'fets': [2, 2]}
+                      for index, duration in enumerate(durations)]}
+
+
+def test_running_stats_match_statistics():
+    values = [3.0, 1.5, 4.0, 1.0, 5.5, 9.0, 2.5]
+    stats = RunningStats()
+    for value in values:
+        stats.add(value)
+    assert stats.count == len(values)
+    assert (stats.minimum, stats.maximum) == (min(values), max(values))
+    assert stats.mean == pytest.approx(statistics.mean(values))
+    assert stats.std == pytest.approx(statistics.stdev(values))
+
+    restored = RunningStats.from_dict(json.loads(json.dumps(stats.to_dict())))
+    restored.add(7.0)
+    assert restored.std == pytest.approx(statistics.stdev(values + [7.0]))
+    assert RunningStats().std == 0.0
+
+
+def test_run_trips_hot_dtl(topology, tmp_path):
+    hot = topology.present(ROLE_DTL)[0]
+    ops = FakeOps(hot=hot)
+    runner = SoakRunner(ops, topology, schedule(0.03), str(tmp_path / 'checkpoint.json'))
+    assert runner.run()
+
+    assert runner.state['finished'] and ops.sweeps == runner.state['sweeps'] > 0
+    assert ops.dpms is True
+    assert runner.state['tripped'] == [hot]
+    # Unloaded at the end
+    assert set(ops.fets.values()) == {(0, 0)}
+    trips = {name: sled['thermal_trips'] for name, sled in runner.state['sleds'].items()}
+    assert sum(trips.values()) == 1
+
+    report = runner.report()
+    sled = next(sled for sled in report['sleds'].values() if sled['dtl'] == hex(hot))
+    assert sled['thermal_trips'] == 1 and sled['timeouts'] == 0
+    assert sled['dtl_temp']['max'] == 120
+    assert sled['dpm_power']['mean'] == pytest.approx(24.0)
+
+
+def test_checkpoint_resume(topology, tmp_path):
+    path = str(tmp_path / 'checkpoint.json')
+    runner = SoakRunner(FakeOps(), topology, schedule(0.02, 0.04), path)
+    runner.poll()
+    runner.state.update(step=1, step_elapsed=0.03, run_seconds=0.05)
+    runner.state['tripped'] = [topology.present(ROLE_DTL)[0]]
+    runner.checkpoint()
+
+    ops = FakeOps()
+    resumed = SoakRunner(ops, topology, None, path)
+    assert resumed.resume()
+    assert resumed.schedule == runner.schedule
+    assert resumed.state['sweeps'] == 1
+    assert resumed.run()
+    # Only the time left in the second step was run, and its tripped DTL stayed off
+    assert resumed.state['run_seconds'] < 0.05 + 0.02
+    assert topology.present(ROLE_DTL)[0] not in [address for address, fets in ops.fets.items() if fets != (0, 0)]
+    name = next(iter(resumed.sleds))
+    assert resumed.state['sleds'][name]['polls'] == resumed.state['sweeps']
+
+    assert not SoakRunner(None, topology, None, str(tmp_path / 'none.json')).resume()
+
+
+def test_unload_failure_keeps_the_original_error(topology, tmp_path):
+    class BrokenOps(FakeOps):
+        def sweep(self, *args):
+            raise ConnectionError('broker went away')
+
+        def set_fets_batch(self, targets):
+            if set(targets.values()) == {(0, 0)}:
+                raise ConnectionError('still gone')
+            return super().set_fets_batch(targets)
+
+    runner = SoakRunner(BrokenOps(), topology, schedule(1), str(tmp_path / 'checkpoint.json'))
+    with pytest.raises(ConnectionError, match='broker went away'):
+        runner.run()
+
+
+def test_report_skips_sleds_not_in_the_topology(topology, tmp_path):
+    path = str(tmp_path / 'checkpoint.json')
+    runner = SoakRunner(FakeOps(), topology, schedule(1), path)
+    runner.poll()
+    runner.checkpoint()
+
+    smaller = Topology({'sleds_per_dba': 4, 'cubes': [{'name': 'Cube1', 'dbas': [{'dba': 1}]}]})
+    resumed = SoakRunner(None, smaller, None, path)
+    assert resumed.resume()
+    assert sorted(resumed.report()['sleds']) == sorted(resumed.sleds)
+
+
+def test_write_report(topology, tmp_path):
+    runner = SoakRunner(FakeOps(), topology, schedule(1), str(tmp_path / 'checkpoint.json'))
+    runner.poll()
+    runner.state['run_seconds'] = 1.0
+    path = str(tmp_path / 'report.json')
+    write_report(runner.report(), path)
+
+    with open(path) as report_file:
+        report = json.load(report_file)
+    assert len(report['sleds']) == len(topology.present(ROLE_DPM))
+    with open(str(tmp_path / 'report.csv')) as csv_file:
+        rows = list(csv.DictReader(csv_file))
+    assert len(rows) == len(report['sleds'])
+    assert float(rows[0]['poll_rate']) == 1.0
+    assert all('{}_mean'.format(metric) in rows[0] for metric in METRICS)
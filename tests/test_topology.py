@@ -0,0 +1,71 @@
+import json
+import os
+
+import pytest
+
+from topology import Topology, TOPOLOGY_FILE, ROLE_DPM, ROLE_DTL
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_default_topology_addresses():
+    topology = Topology.load(os.path.join(ROOT, TOPOLOGY_FILE))
+    assert len(topology.devices) == 64
+    assert topology.by_name['DBA1_DPM1'] == 0x00
+    assert topology.by_name['DBA2_DPM1'] == 0x10
+    assert topology.by_name['DBA4_DTL8'] == 0xB7
+    assert topology.location[0x93] == ('Cube1', 2, 4)
+    assert topology.role_of[0x93] == ROLE_DTL
+    assert topology.partner(0x93) == 0x13
+    assert topology.partner(0x13) == 0x93
+    assert topology.address('Cube1', 3, 1, ROLE_DPM) == 0x20
+
+
+def test_present_bitset(topology):
+    topology.clear_present()
+    assert topology.present() == []
+    assert topology.mark_present(0x81)
+    assert topology.mark_present(0x02)
+    assert not topology.mark_present(0x7F)
+    assert topology.is_present(0x81) and not topology.is_present(0x80) and not topology.is_present(0x7F)
+    assert topology.present(ROLE_DTL) == [0x81]
+    assert topology.present(ROLE_DPM) == [0x02]
+    assert sorted(topology.present()) == [0x02, 0x81]
+    assert topology.count_present() == 2
+    assert topology.count_present(ROLE_DPM) == 1
+
+
+def test_dba_overrides():
+    topology = Topology({'cubes': [{'name': 'Cube1', 'dbas': [{'dba': 1, 'sleds': 2},
+                                                              {'dba': 2, 'dpm_base': '0x50', 'dtl_base': 0xD0}]}]})
+    assert sorted(topology.by_role[ROLE_DPM]) == [0x00, 0x01] + list(range(0x50, 0x58))
+    assert topology.address('Cube1', 2, 1, ROLE_DTL) == 0xD0
+    assert [dba.sleds for dba in topology.dbas] == [2, 8]
+
+
+def test_second_cube_gets_its_own_addresses():
+    config = {'cubes': [{'name': 'A', 'dbas': [{'dba': 1}]}, {'name': 'B', 'dbas': [{'dba': 1}]}]}
+    topology = Topology(config)
+    assert topology.by_name['A_DBA1_DPM1'] == 0x00
+    assert topology.by_name['B_DBA1_DPM1'] == 0x40
+    assert topology.by_name['B_DBA1_DTL1'] == 0xC0
+
+    config['cubes'][1].update(dpm_base='0x20', dtl_base='0xA0')
+    assert Topology(config).by_name['B_DBA1_DTL1'] == 0xA0
+
+
+def test_overlapping_addresses_are_rejected():
+    config = {'address_scheme': {'cube_stride': 0},
+              'cubes': [{'name': 'A', 'dbas': [{'dba': 1}]}, {'name': 'B', 'dbas': [{'dba': 1}]}]}
+    with pytest.raises(ValueError, match='dpm_base'):
+        Topology(config)
+
+
+def test_dtl_limits_merge_with_defaults(tmp_path):
+    path = tmp_path / 'rig.json'
+    path.write_text(json.dumps({'cubes': [{'name': 'Cube1', 'dbas': [{'dba': 1}]}],
+                                'dtl': {'max_fets_12v': 4}}))
+    topology = Topology.load(str(path))
+    assert topology.dtl['max_fets_12v'] == 4
+    assert topology.dtl['max_fets_5v'] == 8
+    assert topology.supplies == {}
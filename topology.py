@@ -0,0 +1,144 @@
+##
+# Module with the cube topology used by the CUBEMELTER Tool
+#
+# The topology is loaded from a json file (see topology.json) describing the cubes,
+# their DBAs, how many sleds each DBA has, how addresses are assigned, the supply LUNs
+# and what the DTLs can load.
+# Addresses may be written as ints or as "0x.." strings.
+#
+# The sleds of a DBA get consecutive addresses from its base. A DBA's base is
+#   role base + (cube index * cube_stride) + (dba - 1) * dba_stride
+# where a cube can set its own dpm_base/dtl_base instead of the first two terms, and a
+# DBA can set its own dpm_base/dtl_base outright.
+
+import json
+from collections import namedtuple
+
+TOPOLOGY_FILE = 'topology.json'
+
+ROLE_DPM = 'dpm'
+ROLE_DTL = 'dtl'
+ROLES = (ROLE_DPM, ROLE_DTL)
+
+# A device on the DBA bus. slot is the 1 based sled number within the DBA
+Device = namedtuple('Device', ['name', 'role', 'address', 'cube', 'dba', 'slot'])
+
+# A DBA and the number of sleds it holds
+Dba = namedtuple('Dba', ['cube', 'dba', 'sleds'])
+
+# What a DTL can load, the watts per fet are only starting estimates for the power controller
+DTL_DEFAULTS = {'max_fets_5v': 8, 'max_fets_12v': 8, 'watts_per_fet_5v': 5.0, 'watts_per_fet_12v': 12.0}
+
+
+def _int(value):
+    """Config values may be ints or strings like '0x80'"""
+    return value if isinstance(value, int) else int(value, 0)
+
+
+class Topology:
+    """Precomputed address indexes for the devices of one or more cubes"""
+
+    def __init__(self, config):
+        """Initializes a Topology
+
+        Args:
+            config: dict with the same layout as topology.json
+
+        Raises:
+            ValueError if two devices end up with the same address
+        """
+        scheme = config.get('address_scheme', dict())
+        default_sleds = config.get('sleds_per_dba', 8)
+        stride = _int(scheme.get('dba_stride', 0x10))
+        cube_stride = _int(scheme.get('cube_stride', 0x40))
+        bases = {ROLE_DPM: _int(scheme.get('dpm_base', 0x00)),
+                 ROLE_DTL: _int(scheme.get('dtl_base', 0x80))}
+
+        self.devices = list()
+        self.dbas = list()
+        for cube_index, cube in enumerate(config['cubes']):
+            cube_name = cube['name']
+            cube_bases = {role: _int(cube[role + '_base']) if role + '_base' in cube
+                          else bases[role] + cube_index * cube_stride
+                          for role in ROLES}
+            for dba_config in cube['dbas']:
+                dba_num = dba_config['dba']
+                sleds = dba_config.get('sleds', default_sleds)
+                self.dbas.append(Dba(cube_name, dba_num, sleds))
+                for slot in range(1, sleds + 1):
+                    for role in ROLES:
+                        base = dba_config.get(role + '_base')
+                        base = _int(base) if base is not None else cube_bases[role] + (dba_num - 1) * stride
+                        name = 'DBA{}_{}{}'.format(dba_num, role.upper(), slot)
+                        if len(config['cubes']) > 1:
+                            name = '{}_{}'.format(cube_name, name)
+                        self.devices.append(Device(name, role, base + slot - 1, cube_name, dba_num, slot))
+
+        self.supplies = {name: _int(lun) for name, lun in config.get('supplies', dict()).items()}
+        self.dtl = dict(DTL_DEFAULTS, **config.get('dtl', dict()))
+
+        # address -> bit index, used by the present bitsets
+        self._index = dict()
+        for index, device in enumerate(self.devices):
+            if device.address in self._index:
+                raise ValueError('Address {} is used by both {} and {}, give the cube or DBA its own '
+                                 'dpm_base/dtl_base or change the cube_stride'.format(
+                                     hex(device.address), self.devices[self._index[device.address]].name,
+                                     device.name))
+            self._index[device.address] = index
+
+        self.by_name = {device.name: device.address for device in self.devices}
+        self.by_role = {role: frozenset(device.address for device in self.devices if device.role == role)
+                        for role in ROLES}
+        self.location = {device.address: (device.cube, device.dba, device.slot) for device in self.devices}
+        self.role_of = {device.address: device.role for device in self.devices}
+        self._by_location = {(device.cube, device.dba, device.slot, device.role): device.address
+                             for device in self.devices}
+        self._role_mask = {role: sum(1 << self._index[address] for address in self.by_role[role])
+                           for role in ROLES}
+        self._present = 0
+
+    @classmethod
+    def load(cls, path):
+        """Loads a Topology from a json file"""
+        with open(path) as config_file:
+            return cls(json.load(config_file))
+
+    def address(self, cube, dba, slot, role):
+        """Address of the device with the given role in a sled"""
+        return self._by_location[(cube, dba, slot, role)]
+
+    def partner(self, address):
+        """Address of the other device (DPM <-> DTL) in the same sled"""
+        cube, dba, slot = self.location[address]
+        other = ROLE_DTL if self.role_of[address] == ROLE_DPM else ROLE_DPM
+        return self._by_location[(cube, dba, slot, other)]
+
+    def mark_present(self, address):
+        """Records a device as present, returns False if the address isn't in the topology"""
+        index = self._index.get(address)
+        if index is None:
+            return False
+        self._present |= 1 << index
+        return True
+
+    def clear_present(self):
+        self._present = 0
+
+    def is_present(self, address):
+        index = self._index.get(address)
+        return index is not None and bool(self._present >> index & 1)
+
+    def present(self, role=None):
+        """Addresses of the present devices, optionally only those with a given role"""
+        mask = self._present if role is None else self._present & self._role_mask[role]
+        addresses = list()
+        while mask:
+            low_bit = mask & -mask
+            addresses.append(self.devices[low_bit.bit_length() - 1].address)
+            mask ^= low_bit
+        return addresses
+
+    def count_present(self, role=None):
+        mask = self._present if role is None else self._present & self._role_mask[role]
+        return bin(mask).count('1')